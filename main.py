@@ -1,13 +1,31 @@
+from __future__ import annotations
+
 import os
 import re
+import json
 import asyncio
 import asyncpg
 import logging
 import signal
+import time
+import zipfile
+import multiprocessing
+import tempfile
+import random
+import heapq
+import itertools
+import statistics
+import subprocess
+import sys
+from typing import TYPE_CHECKING
+from collections import OrderedDict, deque
+from queue import Empty
+from dataclasses import dataclass, field
+from enum import Enum
 from datetime import datetime, timezone
-from openai import AsyncOpenAI
 from http.server import BaseHTTPRequestHandler, HTTPServer
 import threading
+import httpx
 from telegram import (
     Update,
     InlineKeyboardButton,
@@ -17,14 +35,12 @@ from telegram import (
     ReplyKeyboardRemove,
 )
 from telegram.constants import ChatMemberStatus, ChatAction
-from telegram.ext import (
-    Application,
-    CommandHandler,
-    CallbackQueryHandler,
-    MessageHandler,
-    ContextTypes,
-    filters,
-)
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+
+# telegram.ext and openai are heavy to import and not needed by the front
+# process in multi-worker mode; they are imported where they are first used.
+if TYPE_CHECKING:
+    from telegram.ext import Application, ContextTypes
 
 # ============== LOGGING SETUP ==============
 logging.basicConfig(
@@ -37,10 +53,21 @@ logger = logging.getLogger(__name__)
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
 DATABASE_URL = os.environ.get("DATABASE_URL")
 OWNER_ID = 7728424218
-client = AsyncOpenAI(
-    api_key=os.environ.get("AI_INTEGRATIONS_OPENAI_API_KEY"),
-    base_url=os.environ.get("AI_INTEGRATIONS_OPENAI_BASE_URL"),
-)
+WORKERS = int(os.environ.get("WORKERS", "1"))
+
+LLM_MODEL = os.environ.get("LLM_MODEL", "llama-3.3-70b-versatile")
+LLM_CHEAP_MODEL = os.environ.get("LLM_CHEAP_MODEL", "llama-3.1-8b-instant")
+_llm_client = None
+
+def get_llm():
+    global _llm_client
+    if _llm_client is None:
+        from openai import AsyncOpenAI
+        _llm_client = AsyncOpenAI(
+            api_key=os.environ.get("AI_INTEGRATIONS_OPENAI_API_KEY"),
+            base_url=os.environ.get("AI_INTEGRATIONS_OPENAI_BASE_URL"),
+        )
+    return _llm_client
 
 # ============== DATABASE POOL ==============
 db_pool = None
@@ -94,80 +121,307 @@ MEDIA TAGS (use naturally, not every message):
 def now_iso():
     return datetime.now(timezone.utc).isoformat()
 
+_BACKGROUND_TASKS = set()
+
+def fire_and_forget(coro):
+    """Run a coroutine in the background, keeping a reference so it isn't GC'd mid-flight."""
+    task = asyncio.create_task(coro)
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_on_background_done)
+    return task
+
+def _on_background_done(task):
+    _BACKGROUND_TASKS.discard(task)
+    if not task.cancelled() and task.exception():
+        logger.error(f"Background task error: {task.exception()}")
+
+TYPING_REFRESH = 4.5
+
+async def keep_typing(bot, chat_id):
+    """Telegram clears a chat action after ~5s, so keep re-sending it until cancelled."""
+    while True:
+        try:
+            await bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+        except Exception:
+            pass
+        await asyncio.sleep(TYPING_REFRESH)
+
+async def send_random_asset(bot, chat_id, asset_type: str, lookup=None):
+    """Send a random pic/sticker; `lookup` is an already-running get_random_asset() task."""
+    file_id = await lookup if lookup else await get_random_asset(asset_type)
+    if not file_id:
+        return
+    if asset_type == "pic":
+        await bot.send_photo(chat_id=chat_id, photo=file_id)
+    else:
+        await bot.send_sticker(chat_id=chat_id, sticker=file_id)
+
 async def is_owner(user_id: int) -> bool:
     return user_id == OWNER_ID
 
 async def is_admin(user_id: int) -> bool:
-    if user_id == OWNER_ID:
-        return True
-    pool = await get_db()
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT 1 FROM admins WHERE user_id=$1", user_id)
-    return bool(row)
+    return user_id == OWNER_ID or user_id in ADMIN_IDS
 
 async def is_blocked(user_id: int) -> bool:
-    pool = await get_db()
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT 1 FROM blocked_users WHERE user_id=$1", user_id)
-    return bool(row)
+    return user_id in BLOCKED_IDS
 
 # ============== DATABASE INIT ==============
+# Bump SCHEMA_VERSION whenever SCHEMA_SQL changes; boots with a matching
+# version skip the DDL entirely.
+SCHEMA_VERSION = 2
+SCHEMA_SQL = """
+    CREATE TABLE IF NOT EXISTS users (
+        user_id BIGINT PRIMARY KEY,
+        first_name TEXT,
+        username TEXT,
+        nickname TEXT,
+        started_at TEXT,
+        mood TEXT DEFAULT 'neutral'
+    );
+    ALTER TABLE users ADD COLUMN IF NOT EXISTS nickname TEXT;
+    CREATE TABLE IF NOT EXISTS messages (
+        id SERIAL PRIMARY KEY,
+        user_id BIGINT,
+        role TEXT,
+        text TEXT,
+        ts TEXT
+    );
+    -- Search vector is kept by a trigger rather than a generated column, which
+    -- would rewrite the whole table under lock. Old rows are backfilled and
+    -- indexed in the background by build_message_indexes()
+    ALTER TABLE messages ADD COLUMN IF NOT EXISTS tsv tsvector;
+    CREATE OR REPLACE FUNCTION messages_tsv_update() RETURNS trigger AS $$
+    BEGIN
+        NEW.tsv := to_tsvector('simple', coalesce(NEW.text, ''));
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql;
+    DROP TRIGGER IF EXISTS messages_tsv_trigger ON messages;
+    CREATE TRIGGER messages_tsv_trigger BEFORE INSERT OR UPDATE OF text ON messages
+        FOR EACH ROW EXECUTE FUNCTION messages_tsv_update();
+    CREATE TABLE IF NOT EXISTS user_facts (
+        user_id BIGINT,
+        kind TEXT,
+        value TEXT,
+        updated_at TEXT,
+        PRIMARY KEY (user_id, kind, value)
+    );
+    CREATE TABLE IF NOT EXISTS assets (
+        id SERIAL PRIMARY KEY,
+        type TEXT,
+        file_id TEXT UNIQUE
+    );
+    ALTER TABLE assets ADD COLUMN IF NOT EXISTS file_unique_id TEXT;
+    CREATE UNIQUE INDEX IF NOT EXISTS assets_file_unique_id_key ON assets(file_unique_id);
+    CREATE TABLE IF NOT EXISTS admins (
+        user_id BIGINT PRIMARY KEY,
+        added_by BIGINT,
+        added_at TEXT
+    );
+    CREATE TABLE IF NOT EXISTS blocked_users (
+        user_id BIGINT PRIMARY KEY,
+        blocked_by BIGINT,
+        blocked_at TEXT
+    );
+    CREATE TABLE IF NOT EXISTS channels (
+        id SERIAL PRIMARY KEY,
+        channel_id TEXT UNIQUE,
+        channel_link TEXT,
+        channel_name TEXT
+    );
+    CREATE TABLE IF NOT EXISTS llm_usage (
+        user_id BIGINT,
+        day TEXT,
+        requests INTEGER DEFAULT 0,
+        prompt_tokens BIGINT DEFAULT 0,
+        completion_tokens BIGINT DEFAULT 0,
+        cached_tokens BIGINT DEFAULT 0,
+        latency_ms BIGINT DEFAULT 0,
+        PRIMARY KEY (user_id, day)
+    );
+    CREATE TABLE IF NOT EXISTS schema_meta (
+        id INTEGER PRIMARY KEY DEFAULT 1,
+        version INTEGER
+    );
+"""
+
+async def get_schema_version(conn):
+    try:
+        return await conn.fetchval("SELECT version FROM schema_meta WHERE id=1")
+    except asyncpg.UndefinedTableError:
+        return None
+
 async def init_db():
     pool = await get_db()
     async with pool.acquire() as conn:
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id BIGINT PRIMARY KEY,
-                first_name TEXT,
-                username TEXT,
-                nickname TEXT,
-                started_at TEXT,
-                mood TEXT DEFAULT 'neutral'
-            )
-        """)
-        cols = await conn.fetch("SELECT column_name FROM information_schema.columns WHERE table_name='users' AND column_name='nickname'")
-        if not cols:
-            await conn.execute("ALTER TABLE users ADD COLUMN nickname TEXT")
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS messages (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT,
-                role TEXT,
-                text TEXT,
-                ts TEXT
-            )
-        """)
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS assets (
-                id SERIAL PRIMARY KEY,
-                type TEXT,
-                file_id TEXT UNIQUE
-            )
-        """)
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS admins (
-                user_id BIGINT PRIMARY KEY,
-                added_by BIGINT,
-                added_at TEXT
-            )
-        """)
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS blocked_users (
-                user_id BIGINT PRIMARY KEY,
-                blocked_by BIGINT,
-                blocked_at TEXT
-            )
-        """)
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS channels (
-                id SERIAL PRIMARY KEY,
-                channel_id TEXT UNIQUE,
-                channel_link TEXT,
-                channel_name TEXT
+        if await get_schema_version(conn) == SCHEMA_VERSION:
+            logger.info("Database schema up to date")
+            return
+        async with conn.transaction():
+            # Several workers may boot at once; only one runs the DDL
+            await conn.execute("SELECT pg_advisory_xact_lock(hashtext('alya_schema'))")
+            await conn.execute("CREATE TABLE IF NOT EXISTS schema_meta (id INTEGER PRIMARY KEY DEFAULT 1, version INTEGER)")
+            if await conn.fetchval("SELECT version FROM schema_meta WHERE id=1") == SCHEMA_VERSION:
+                return
+            await conn.execute(SCHEMA_SQL)
+            await conn.execute(
+                "INSERT INTO schema_meta(id, version) VALUES(1, $1) ON CONFLICT(id) DO UPDATE SET version=$1",
+                SCHEMA_VERSION
             )
-        """)
     logger.info("Database initialized")
 
+# Indexes on messages are built after the bot is up: CREATE INDEX
+# CONCURRENTLY can't run inside the schema transaction and doesn't block
+# writes, at the cost of taking longer. Until they exist, history and memory
+# lookups fall back to slower plans.
+HISTORY_INDEX = "messages_user_id_idx"
+SEARCH_INDEX = "messages_user_tsv_idx"
+SEARCH_BACKFILL_BATCH = 5000
+
+async def _index_valid(conn, name: str):
+    """True/False for an existing index (False = interrupted build), None if missing."""
+    return await conn.fetchval("""
+        SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = $1
+    """, name)
+
+async def _build_index(conn, name: str, definition: str):
+    valid = await _index_valid(conn, name)
+    if valid:
+        return
+    if valid is False:
+        # Left behind by an interrupted CONCURRENTLY build
+        await conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+    started = time.perf_counter()
+    await conn.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} {definition}")
+    logger.info(f"Index {name} ready in {_elapsed_ms(started)}ms")
+
+async def build_message_indexes():
+    pool = await get_db()
+    async with pool.acquire() as conn:
+        if not await conn.fetchval("SELECT pg_try_advisory_lock(hashtext('alya_message_indexes'))"):
+            return  # another worker is on it
+        try:
+            await _build_index(conn, HISTORY_INDEX, "ON messages (user_id, id)")
+            if await _index_valid(conn, SEARCH_INDEX):
+                return
+            try:
+                await conn.execute("CREATE EXTENSION IF NOT EXISTS btree_gin")
+            except asyncpg.PostgresError as e:
+                logger.error(f"btree_gin unavailable, memory search stays unindexed: {e}")
+                return
+            last_id = await conn.fetchval("SELECT coalesce(max(id), 0) FROM messages")
+            for low in range(0, last_id, SEARCH_BACKFILL_BATCH):
+                await conn.execute("""
+                    UPDATE messages SET tsv = to_tsvector('simple', coalesce(text, ''))
+                    WHERE id > $1 AND id <= $2 AND tsv IS NULL
+                """, low, low + SEARCH_BACKFILL_BATCH)
+            await _build_index(conn, SEARCH_INDEX, "ON messages USING GIN (user_id, tsv)")
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock(hashtext('alya_message_indexes'))")
+
+# ============== CACHES ==============
+# Admins, blocked users, channels and asset file_ids are read on hot paths but
+# change rarely, so they are held in memory. Writers reload the cache and
+# NOTIFY other processes (multi-worker mode) to reload theirs.
+CACHE_CHANNEL = "alya_cache"
+ADMIN_IDS = set()
+BLOCKED_IDS = set()
+CHANNELS_CACHE = []
+ASSET_CACHE = {"pic": [], "sticker": []}
+# Backstop for notifications lost while the listener was down or reconnecting
+CACHE_RELOAD_INTERVAL = 300
+LISTENER_RETRY_MAX = 60
+_cache_listener = None
+
+async def _load_admins(conn):
+    rows = await conn.fetch("SELECT user_id FROM admins")
+    ADMIN_IDS.clear()
+    ADMIN_IDS.update(r['user_id'] for r in rows)
+
+async def _load_blocked(conn):
+    rows = await conn.fetch("SELECT user_id FROM blocked_users")
+    BLOCKED_IDS.clear()
+    BLOCKED_IDS.update(r['user_id'] for r in rows)
+
+async def _load_channels(conn):
+    rows = await conn.fetch("SELECT channel_id, channel_link, channel_name FROM channels")
+    CHANNELS_CACHE[:] = [{"id": r['channel_id'], "link": r['channel_link'], "name": r['channel_name']} for r in rows]
+
+async def _load_assets(conn):
+    rows = await conn.fetch("SELECT type, file_id FROM assets ORDER BY id")
+    cache = {"pic": [], "sticker": []}
+    for r in rows:
+        cache.setdefault(r['type'], []).append(r['file_id'])
+    ASSET_CACHE.clear()
+    ASSET_CACHE.update(cache)
+
+CACHE_LOADERS = {
+    "admins": _load_admins,
+    "blocked": _load_blocked,
+    "channels": _load_channels,
+    "assets": _load_assets,
+}
+
+async def load_cache(name: str):
+    pool = await get_db()
+    async with pool.acquire() as conn:
+        await CACHE_LOADERS[name](conn)
+
+async def warm_caches():
+    await asyncio.gather(*(load_cache(name) for name in CACHE_LOADERS))
+
+async def invalidate_cache(*names: str):
+    """Reload caches after a write here, and tell other processes to do the same."""
+    await asyncio.gather(*(load_cache(name) for name in names))
+    pool = await get_db()
+    async with pool.acquire() as conn:
+        for name in names:
+            await conn.execute("SELECT pg_notify($1, $2)", CACHE_CHANNEL, f"{name}:{os.getpid()}")
+
+def _on_cache_notify(conn, pid, channel, payload):
+    name, _, sender = payload.partition(":")
+    if name in CACHE_LOADERS and sender != str(os.getpid()):
+        fire_and_forget(load_cache(name))
+
+async def start_cache_listener():
+    global _cache_listener
+    conn = await asyncpg.connect(DATABASE_URL)
+    await conn.add_listener(CACHE_CHANNEL, _on_cache_notify)
+    conn.add_termination_listener(_on_listener_lost)
+    _cache_listener = conn
+
+def _on_listener_lost(conn):
+    # Shutdown clears _cache_listener before closing it, so only an unexpected
+    # drop of the current connection triggers a reconnect
+    if conn is _cache_listener:
+        logger.warning("Cache listener connection lost, reconnecting")
+        fire_and_forget(reconnect_cache_listener())
+
+async def reconnect_cache_listener():
+    global _cache_listener
+    _cache_listener = None
+    delay = 1
+    while True:
+        try:
+            await start_cache_listener()
+            break
+        except Exception as e:
+            logger.error(f"Cache listener reconnect failed, retrying in {delay}s: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, LISTENER_RETRY_MAX)
+    # Anything changed while we were disconnected was never heard about
+    await warm_caches()
+    logger.info("Cache listener reconnected")
+
+async def cache_reload_loop():
+    while True:
+        await asyncio.sleep(CACHE_RELOAD_INTERVAL)
+        try:
+            await warm_caches()
+        except Exception as e:
+            logger.error(f"Cache reload error: {e}")
+
 # ============== USER FUNCTIONS ==============
 async def upsert_user(u):
     pool = await get_db()
@@ -215,37 +469,44 @@ async def clear_user_data(user_id: int):
     pool = await get_db()
     async with pool.acquire() as conn:
         await conn.execute("DELETE FROM messages WHERE user_id=$1", user_id)
+        await conn.execute("DELETE FROM user_facts WHERE user_id=$1", user_id)
 
 async def clear_all_data():
     pool = await get_db()
     async with pool.acquire() as conn:
         await conn.execute("DELETE FROM messages")
+        await conn.execute("DELETE FROM user_facts")
         await conn.execute("DELETE FROM users")
         await conn.execute("DELETE FROM assets")
+    await invalidate_cache("assets")
 
 # ============== ASSET FUNCTIONS ==============
-async def add_asset(asset_type: str, file_id: str):
+async def add_assets(asset_type: str, items) -> int:
+    """Insert (file_id, file_unique_id) pairs in one statement; returns how many were new.
+
+    file_unique_id is the same for every upload of a picture, so it catches
+    re-uploads that file_id alone misses. It may be None for raw file_id imports.
+    """
+    if not items:
+        return 0
     pool = await get_db()
     async with pool.acquire() as conn:
-        await conn.execute(
-            "INSERT INTO assets (type, file_id) VALUES ($1, $2) ON CONFLICT (file_id) DO NOTHING",
-            asset_type, file_id
-        )
+        rows = await conn.fetch("""
+            INSERT INTO assets (type, file_id, file_unique_id)
+            SELECT $1, f, uf FROM unnest($2::text[], $3::text[]) AS t(f, uf)
+            ON CONFLICT DO NOTHING
+            RETURNING id
+        """, asset_type, [f for f, _ in items], [uf for _, uf in items])
+    if rows:
+        await invalidate_cache("assets")
+    return len(rows)
 
 async def get_random_asset(asset_type: str):
-    pool = await get_db()
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow(
-            "SELECT file_id FROM assets WHERE type=$1 ORDER BY RANDOM() LIMIT 1",
-            asset_type
-        )
-    return row['file_id'] if row else None
+    file_ids = ASSET_CACHE.get(asset_type)
+    return random.choice(file_ids) if file_ids else None
 
 async def get_all_assets(asset_type: str):
-    pool = await get_db()
-    async with pool.acquire() as conn:
-        rows = await conn.fetch("SELECT file_id FROM assets WHERE type=$1", asset_type)
-    return [r['file_id'] for r in rows]
+    return list(ASSET_CACHE.get(asset_type, []))
 
 # ============== ADMIN FUNCTIONS ==============
 async def add_admin(user_id: int, added_by: int):
@@ -255,17 +516,16 @@ async def add_admin(user_id: int, added_by: int):
             "INSERT INTO admins(user_id, added_by, added_at) VALUES($1, $2, $3) ON CONFLICT DO NOTHING",
             user_id, added_by, now_iso()
         )
+    await invalidate_cache("admins")
 
 async def remove_admin(user_id: int):
     pool = await get_db()
     async with pool.acquire() as conn:
         await conn.execute("DELETE FROM admins WHERE user_id=$1", user_id)
+    await invalidate_cache("admins")
 
 async def get_all_admins():
-    pool = await get_db()
-    async with pool.acquire() as conn:
-        rows = await conn.fetch("SELECT user_id FROM admins")
-    return [r['user_id'] for r in rows]
+    return sorted(ADMIN_IDS)
 
 # ============== BLOCK FUNCTIONS ==============
 async def block_user(user_id: int, blocked_by: int):
@@ -275,11 +535,13 @@ async def block_user(user_id: int, blocked_by: int):
             "INSERT INTO blocked_users(user_id, blocked_by, blocked_at) VALUES($1, $2, $3) ON CONFLICT DO NOTHING",
             user_id, blocked_by, now_iso()
         )
+    await invalidate_cache("blocked")
 
 async def unblock_user(user_id: int):
     pool = await get_db()
     async with pool.acquire() as conn:
         await conn.execute("DELETE FROM blocked_users WHERE user_id=$1", user_id)
+    await invalidate_cache("blocked")
 
 # ============== CHANNEL FUNCTIONS ==============
 async def add_channel(channel_id: str, channel_link: str, channel_name: str):
@@ -289,17 +551,16 @@ async def add_channel(channel_id: str, channel_link: str, channel_name: str):
             "INSERT INTO channels(channel_id, channel_link, channel_name) VALUES($1, $2, $3) ON CONFLICT(channel_id) DO UPDATE SET channel_link=$2, channel_name=$3",
             channel_id, channel_link, channel_name
         )
+    await invalidate_cache("channels")
 
 async def remove_channel(channel_id: str):
     pool = await get_db()
     async with pool.acquire() as conn:
         await conn.execute("DELETE FROM channels WHERE channel_id=$1", channel_id)
+    await invalidate_cache("channels")
 
 async def get_all_channels():
-    pool = await get_db()
-    async with pool.acquire() as conn:
-        rows = await conn.fetch("SELECT channel_id, channel_link, channel_name FROM channels")
-    return [{"id": r['channel_id'], "link": r['channel_link'], "name": r['channel_name']} for r in rows]
+    return list(CHANNELS_CACHE)
 
 async def is_joined_all_channels(bot, user_id: int) -> bool:
     channels = await get_all_channels()
@@ -314,6 +575,461 @@ async def is_joined_all_channels(bot, user_id: int) -> bool:
             return False
     return True
 
+# ============== LLM USAGE LEDGER ==============
+# Daily token quota per user (prompt + completion). 0 disables quotas.
+DAILY_TOKEN_QUOTA = int(os.environ.get("DAILY_TOKEN_QUOTA", "0"))
+QUOTA_SHORT_HISTORY_AT = float(os.environ.get("QUOTA_SHORT_HISTORY_AT", "0.6"))
+QUOTA_CHEAP_MODEL_AT = float(os.environ.get("QUOTA_CHEAP_MODEL_AT", "0.85"))
+HISTORY_LIMIT = 16
+SHORT_HISTORY_LIMIT = 6
+USAGE_FLUSH_INTERVAL = 30
+
+# (user_id, day) -> [requests, prompt_tokens, completion_tokens, cached_tokens, latency_ms]
+USAGE_PENDING = {}
+# user_id -> tokens used today (flushed + pending), reset at UTC midnight
+USAGE_TODAY = {}
+USAGE_DAY = None
+
+def today_str():
+    return datetime.now(timezone.utc).date().isoformat()
+
+def _usage_rollover(day: str):
+    global USAGE_DAY
+    if USAGE_DAY != day:
+        USAGE_DAY = day
+        USAGE_TODAY.clear()
+
+def record_usage(user_id: int, usage, latency_ms: float):
+    """Buffer one completion's usage; written to the DB by flush_usage()."""
+    prompt = getattr(usage, "prompt_tokens", 0) or 0
+    completion = getattr(usage, "completion_tokens", 0) or 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", 0) or 0
+    day = today_str()
+    _usage_rollover(day)
+    row = USAGE_PENDING.setdefault((user_id, day), [0, 0, 0, 0, 0])
+    row[0] += 1
+    row[1] += prompt
+    row[2] += completion
+    row[3] += cached
+    row[4] += int(latency_ms)
+    if user_id in USAGE_TODAY:
+        USAGE_TODAY[user_id] += prompt + completion
+
+async def flush_usage():
+    if USAGE_PENDING:
+        batch = list(USAGE_PENDING.items())
+        USAGE_PENDING.clear()
+        pool = await get_db()
+        try:
+            async with pool.acquire() as conn:
+                await conn.executemany("""
+                    INSERT INTO llm_usage(user_id, day, requests, prompt_tokens, completion_tokens, cached_tokens, latency_ms)
+                    VALUES($1, $2, $3, $4, $5, $6, $7)
+                    ON CONFLICT(user_id, day) DO UPDATE SET
+                        requests=llm_usage.requests+EXCLUDED.requests,
+                        prompt_tokens=llm_usage.prompt_tokens+EXCLUDED.prompt_tokens,
+                        completion_tokens=llm_usage.completion_tokens+EXCLUDED.completion_tokens,
+                        cached_tokens=llm_usage.cached_tokens+EXCLUDED.cached_tokens,
+                        latency_ms=llm_usage.latency_ms+EXCLUDED.latency_ms
+                """, [(uid, day, *vals) for (uid, day), vals in batch])
+        except Exception:
+            # Put the rows back so the next flush retries them
+            for key, vals in batch:
+                row = USAGE_PENDING.setdefault(key, [0, 0, 0, 0, 0])
+                for i, v in enumerate(vals):
+                    row[i] += v
+            raise
+    # Re-read totals from the DB on next use so usage flushed by other worker
+    # processes counts toward the quota too
+    USAGE_TODAY.clear()
+
+async def usage_flush_loop():
+    while True:
+        await asyncio.sleep(USAGE_FLUSH_INTERVAL)
+        try:
+            await flush_usage()
+        except Exception as e:
+            logger.error(f"Usage flush error: {e}")
+
+async def get_tokens_today(user_id: int) -> int:
+    day = today_str()
+    _usage_rollover(day)
+    if user_id not in USAGE_TODAY:
+        pool = await get_db()
+        async with pool.acquire() as conn:
+            row = await conn.fetchrow(
+                "SELECT prompt_tokens + completion_tokens AS total FROM llm_usage WHERE user_id=$1 AND day=$2",
+                user_id, day
+            )
+        pending = USAGE_PENDING.get((user_id, day))
+        used = (row['total'] if row else 0) + (pending[1] + pending[2] if pending else 0)
+        USAGE_TODAY.setdefault(user_id, used)
+    return USAGE_TODAY[user_id]
+
+async def get_quota_plan(user_id: int):
+    """Return (model, history_limit) for this user's next reply, or None once the quota is spent."""
+    if not DAILY_TOKEN_QUOTA or await is_owner(user_id):
+        return LLM_MODEL, HISTORY_LIMIT
+    used = await get_tokens_today(user_id) / DAILY_TOKEN_QUOTA
+    if used >= 1:
+        return None
+    if used >= QUOTA_CHEAP_MODEL_AT:
+        return LLM_CHEAP_MODEL, SHORT_HISTORY_LIMIT
+    if used >= QUOTA_SHORT_HISTORY_AT:
+        return LLM_MODEL, SHORT_HISTORY_LIMIT
+    return LLM_MODEL, HISTORY_LIMIT
+
+async def get_top_usage(limit: int = 10):
+    await flush_usage()
+    pool = await get_db()
+    async with pool.acquire() as conn:
+        rows = await conn.fetch("""
+            SELECT l.user_id, u.first_name, l.requests, l.cached_tokens, l.latency_ms,
+                   l.prompt_tokens + l.completion_tokens AS total
+            FROM llm_usage l LEFT JOIN users u ON u.user_id = l.user_id
+            WHERE l.day=$1
+            ORDER BY total DESC
+            LIMIT $2
+        """, today_str(), limit)
+    return rows
+
+# ============== LONG-TERM MEMORY ==============
+# Older turns are recalled with Postgres full-text search instead of sending
+# the whole history; durable facts are distilled into user_facts in the background.
+MEMORY_RECALL_LIMIT = 4
+MEMORY_SNIPPET_CHARS = 200
+MEMORY_STOPWORDS = {
+    "the", "and", "you", "your", "are", "was", "for", "that", "this", "with", "what",
+    "hai", "hain", "kya", "nahi", "nhi", "main", "mai", "tum", "tumhe", "mujhe", "mera",
+    "meri", "tera", "teri", "aur", "bhi", "toh", "kar", "karo", "haan", "baby", "alya",
+}
+FACT_EXTRACTION = os.environ.get("FACT_EXTRACTION", "1") == "1"
+FACT_EXTRACT_EVERY = 8
+FACT_COUNTERS = {}
+FACT_PROMPT = """
+Extract durable facts about the user from these chat messages he wrote.
+Reply with ONLY a JSON object: {"name": string or null, "likes": [strings], "dislikes": [strings]}.
+Use short lowercase phrases. Only include things he clearly stated about himself. Empty lists if none.
+"""
+
+def _memory_query(text: str) -> str:
+    words = []
+    for w in re.findall(r"[^\W_]{3,}", text.lower()):
+        if w not in MEMORY_STOPWORDS and w not in words:
+            words.append(w)
+    return " | ".join(words[:12])
+
+async def recall_memories(user_id: int, text: str, skip_recent: int, limit: int = MEMORY_RECALL_LIMIT):
+    """Most relevant past turns older than the last `skip_recent` messages, oldest first."""
+    query = _memory_query(text)
+    if not query:
+        return []
+    pool = await get_db()
+    async with pool.acquire() as conn:
+        rows = await conn.fetch("""
+            WITH recent AS (
+                SELECT id FROM messages WHERE user_id=$1 ORDER BY id DESC LIMIT $3
+            )
+            SELECT m.id, m.role, m.text, m.ts
+            FROM messages m, to_tsquery('simple', $2) q
+            WHERE m.user_id=$1
+              AND m.id < COALESCE((SELECT min(id) FROM recent), 0)
+              AND m.tsv @@ q
+            ORDER BY ts_rank(m.tsv, q) DESC, m.id DESC
+            LIMIT $4
+        """, user_id, query, skip_recent, limit)
+    return sorted(rows, key=lambda r: r['id'])
+
+def format_memories(rows) -> str:
+    lines = ["Relevant memories from older chats (bring up naturally, don't quote):"]
+    for r in rows:
+        who = "He" if r['role'] == "user" else "You"
+        lines.append(f"- [{(r['ts'] or '')[:10]}] {who}: {r['text'][:MEMORY_SNIPPET_CHARS]}")
+    return "\n".join(lines)
+
+async def get_user_facts(user_id: int):
+    pool = await get_db()
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(
+            "SELECT kind, value FROM user_facts WHERE user_id=$1 ORDER BY updated_at DESC LIMIT 30",
+            user_id
+        )
+    facts = {}
+    for r in rows:
+        facts.setdefault(r['kind'], []).append(r['value'])
+    return facts
+
+def format_facts(facts: dict) -> str:
+    parts = []
+    if facts.get("name"):
+        parts.append(f"real name: {facts['name'][0]}")
+    if facts.get("like"):
+        parts.append(f"likes: {', '.join(facts['like'])}")
+    if facts.get("dislike"):
+        parts.append(f"dislikes: {', '.join(facts['dislike'])}")
+    return f"Things you know about him - {'; '.join(parts)}. " if parts else ""
+
+def maybe_extract_facts(user_id: int):
+    if not FACT_EXTRACTION:
+        return
+    count = FACT_COUNTERS.get(user_id, 0) + 1
+    if count < FACT_EXTRACT_EVERY:
+        FACT_COUNTERS[user_id] = count
+        return
+    FACT_COUNTERS[user_id] = 0
+    fire_and_forget(extract_facts(user_id))
+
+async def extract_facts(user_id: int):
+    try:
+        pool = await get_db()
+        async with pool.acquire() as conn:
+            rows = await conn.fetch(
+                "SELECT text FROM messages WHERE user_id=$1 AND role='user' ORDER BY id DESC LIMIT $2",
+                user_id, FACT_EXTRACT_EVERY * 2
+            )
+        if not rows:
+            return
+        started = time.perf_counter()
+        response = await get_llm().chat.completions.create(
+            model=LLM_CHEAP_MODEL,
+            messages=[
+                {"role": "system", "content": FACT_PROMPT},
+                {"role": "user", "content": "\n".join(r['text'] for r in reversed(rows))},
+            ],
+            max_completion_tokens=200,
+            temperature=0,
+        )
+        record_usage(user_id, response.usage, (time.perf_counter() - started) * 1000)
+        match = re.search(r"\{.*\}", response.choices[0].message.content or "", flags=re.DOTALL)
+        if not match:
+            return
+        data = json.loads(match.group(0))
+
+        facts = []
+        name = data.get("name")
+        if isinstance(name, str) and name.strip():
+            facts.append(("name", name.strip()[:60]))
+        for kind, key in (("like", "likes"), ("dislike", "dislikes")):
+            values = data.get(key) or []
+            if isinstance(values, list):
+                facts.extend((kind, v.strip().lower()[:60]) for v in values[:5] if isinstance(v, str) and v.strip())
+        if not facts:
+            return
+
+        ts = now_iso()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                if any(kind == "name" for kind, _ in facts):
+                    await conn.execute("DELETE FROM user_facts WHERE user_id=$1 AND kind='name'", user_id)
+                # A like can turn into a dislike (and vice versa) - keep only the latest
+                await conn.executemany(
+                    "DELETE FROM user_facts WHERE user_id=$1 AND kind=$2 AND value=$3",
+                    [(user_id, "dislike" if kind == "like" else "like", value) for kind, value in facts if kind != "name"]
+                )
+                await conn.executemany("""
+                    INSERT INTO user_facts(user_id, kind, value, updated_at) VALUES($1, $2, $3, $4)
+                    ON CONFLICT(user_id, kind, value) DO UPDATE SET updated_at=EXCLUDED.updated_at
+                """, [(user_id, kind, value, ts) for kind, value in facts])
+    except Exception as e:
+        logger.error(f"Fact extraction error: {e}")
+
+# ============== OUTBOUND SCHEDULER ==============
+# Every Bot API call goes through PTB's rate-limiter hook, so all send paths
+# (reply_text, send_*, edit_*) share one set of limits: a global bucket (~30/s,
+# split across workers) and a per-chat bucket (~1/s in private chats, 20/min in
+# groups). Bulk sends pass rate_limit_args={"priority": PRIORITY_BULK} and wait
+# behind interactive replies. RetryAfter and transient network errors are retried.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+GLOBAL_SEND_RATE = 30
+PRIVATE_CHAT_RATE = 1.0
+GROUP_CHAT_RATE = 20 / 60
+CHAT_BURST = 3
+SEND_MAX_RETRIES = 3
+SEND_BACKOFF = 0.5
+CHAT_BUCKETS_MAX = 10000
+CHAT_BUCKET_IDLE = 600
+# RetryAfter from this many distinct chats within the window means the flood
+# limit is global, so every chat is paused rather than just the one that hit it
+GLOBAL_FLOOD_CHATS = 3
+GLOBAL_FLOOD_WINDOW = 5
+# Endpoints that create a message; a retry after the request may have reached
+# Telegram can deliver it twice
+NON_IDEMPOTENT_PREFIXES = ("send", "copy", "forward")
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def reserve(self) -> float:
+        """Take a token (possibly going into debt); returns seconds to wait before using it."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(wait, self.blocked_until - now)
+
+def _retry_after_seconds(e: RetryAfter) -> float:
+    delay = e.retry_after
+    return delay.total_seconds() if hasattr(delay, "total_seconds") else float(delay)
+
+def _safe_to_retry(endpoint: str, error: NetworkError) -> bool:
+    """Idempotent calls always; message-creating ones only if the request never left."""
+    if not endpoint.startswith(NON_IDEMPOTENT_PREFIXES) or endpoint == "sendChatAction":
+        return True
+    # PTB chains the underlying httpx error: connect failures and pool timeouts
+    # happen before anything is sent, read/write timeouts may come after delivery
+    return isinstance(error.__cause__, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+
+class OutboundScheduler:
+    """PTB rate limiter (see BaseRateLimiter) coordinating every outbound Bot API call."""
+
+    def __init__(self, global_rate: float):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets = {}
+        self.waiters = []
+        self.seq = itertools.count()
+        self.pump = None
+        self.recent_floods = deque()  # (monotonic time, chat_id) of recent RetryAfter
+        self.stats = {"sent": 0, "retried": 0, "rate_limited": 0, "failed": 0, "unconfirmed": 0, "dropped": 0}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        if self.pump:
+            self.pump.cancel()
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= CHAT_BUCKETS_MAX:
+                idle_before = time.monotonic() - CHAT_BUCKET_IDLE
+                self.chat_buckets = {k: b for k, b in self.chat_buckets.items() if b.updated > idle_before}
+            rate = PRIVATE_CHAT_RATE if isinstance(chat_id, int) and chat_id > 0 else GROUP_CHAT_RATE
+            bucket = self.chat_buckets[chat_id] = TokenBucket(rate, CHAT_BURST)
+        return bucket
+
+    async def _acquire_global(self, priority: int):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.seq), future))
+        if self.pump is None or self.pump.done():
+            self.pump = asyncio.create_task(self._run_pump())
+        await future
+
+    async def _run_pump(self):
+        # Hands out global tokens one at a time, lowest priority value first
+        while self.waiters:
+            wait = self.global_bucket.reserve()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            while self.waiters:
+                _, _, future = heapq.heappop(self.waiters)
+                if not future.done():
+                    future.set_result(None)
+                    break
+
+    def _on_flood(self, chat_id, delay: float):
+        now = time.monotonic()
+        until = now + delay
+        if chat_id is None:
+            self.global_bucket.blocked_until = max(self.global_bucket.blocked_until, until)
+            return
+        bucket = self._chat_bucket(chat_id)
+        bucket.blocked_until = max(bucket.blocked_until, until)
+        self.recent_floods.append((now, chat_id))
+        while self.recent_floods and self.recent_floods[0][0] < now - GLOBAL_FLOOD_WINDOW:
+            self.recent_floods.popleft()
+        if len({cid for _, cid in self.recent_floods}) >= GLOBAL_FLOOD_CHATS:
+            logger.warning(f"Flood wait across {GLOBAL_FLOOD_CHATS}+ chats, pausing all sends for {delay:.0f}s")
+            self.global_bucket.blocked_until = max(self.global_bucket.blocked_until, until)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        limited = chat_id is not None and endpoint.startswith(("send", "edit", "copy", "forward")) and endpoint != "sendChatAction"
+        priority = (rate_limit_args or {}).get("priority", PRIORITY_INTERACTIVE)
+        attempt = 0
+        while True:
+            if limited:
+                await asyncio.sleep(self._chat_bucket(chat_id).reserve())
+                await self._acquire_global(priority)
+            try:
+                result = await callback(*args, **kwargs)
+                self.stats["sent"] += 1
+                return result
+            except RetryAfter as e:
+                error, delay = e, _retry_after_seconds(e)
+                self.stats["rate_limited"] += 1
+                self._on_flood(chat_id, delay)
+            except (BadRequest, Forbidden):
+                self.stats["failed"] += 1
+                raise
+            except NetworkError as e:
+                if not _safe_to_retry(endpoint, e):
+                    self.stats["unconfirmed"] += 1
+                    logger.warning(f"Not retrying {endpoint} to {chat_id}, it may have been delivered: {e}")
+                    raise
+                error, delay = e, SEND_BACKOFF * 2 ** attempt
+            attempt += 1
+            if attempt > SEND_MAX_RETRIES:
+                self.stats["dropped"] += 1
+                logger.warning(f"Dropping {endpoint} to {chat_id} after {attempt} attempts: {error}")
+                raise error
+            self.stats["retried"] += 1
+            await asyncio.sleep(delay)
+
+OUTBOUND = OutboundScheduler(GLOBAL_SEND_RATE / max(WORKERS, 1))
+BULK = {"priority": PRIORITY_BULK}
+
+# ============== GROUP CONTEXT ==============
+# Recent group messages are kept only in memory: one ring buffer per group,
+# with the least recently active groups evicted once the total text size
+# passes GROUP_CONTEXT_MAX_BYTES. Nothing from groups is written to Postgres.
+GROUP_CONTEXT_MESSAGES = 30
+GROUP_CONTEXT_WINDOW = 15
+GROUP_CONTEXT_MAX_BYTES = int(os.environ.get("GROUP_CONTEXT_MAX_BYTES", str(4 * 1024 * 1024)))
+GROUP_MESSAGE_MAX_CHARS = 300
+
+class GroupContextCache:
+    def __init__(self, max_bytes: int, per_group: int):
+        self.max_bytes = max_bytes
+        self.per_group = per_group
+        self.groups = OrderedDict()  # chat_id -> deque of (name, text, size)
+        self.bytes = 0
+
+    def add(self, chat_id: int, name: str, text: str):
+        text = text[:GROUP_MESSAGE_MAX_CHARS]
+        size = len(name.encode()) + len(text.encode())
+        buf = self.groups.get(chat_id)
+        if buf is None:
+            buf = self.groups[chat_id] = deque()
+        else:
+            self.groups.move_to_end(chat_id)
+        if len(buf) >= self.per_group:
+            self.bytes -= buf.popleft()[2]
+        buf.append((name, text, size))
+        self.bytes += size
+        while self.bytes > self.max_bytes and len(self.groups) > 1:
+            _, evicted = self.groups.popitem(last=False)
+            self.bytes -= sum(item[2] for item in evicted)
+
+    def recent(self, chat_id: int, limit: int):
+        buf = self.groups.get(chat_id)
+        return list(buf)[-limit:] if buf else []
+
+GROUP_CONTEXT = GroupContextCache(GROUP_CONTEXT_MAX_BYTES, GROUP_CONTEXT_MESSAGES)
+
+def format_group_context(items) -> str:
+    lines = ["Recent messages in this group (oldest first):"]
+    lines.extend(f"{name}: {text}" for name, text, _ in items)
+    return "\n".join(lines)
+
 # ============== KEYBOARDS ==============
 def get_owner_keyboard():
     return ReplyKeyboardMarkup([
@@ -358,7 +1074,196 @@ def get_confirmation_keyboard(action: str):
     ])
 
 # ============== COLLECTING MODE ==============
-COLLECTING_MODE = {}
+# Multi-step admin flows (broadcast, add pics, block, add channel ...).
+# A flow is abandoned if the admin goes quiet for COLLECT_TIMEOUT seconds.
+COLLECT_TIMEOUT = 300
+
+class CollectMode(Enum):
+    BROADCAST = "broadcast"
+    PIC = "pic"
+    STICKER = "sticker"
+    BLOCK = "block"
+    UNBLOCK = "unblock"
+    ADD_ADMIN = "add_admin"
+    REMOVE_ADMIN = "remove_admin"
+    ADD_CHANNEL_LINK = "add_channel_link"
+    ADD_CHANNEL_ID = "add_channel_id"
+    ADD_CHANNEL_NAME = "add_channel_name"
+    REMOVE_CHANNEL = "remove_channel"
+
+@dataclass
+class CollectState:
+    mode: CollectMode
+    data: dict = field(default_factory=dict)
+    expires_at: float = 0.0
+
+COLLECTING_MODE = {}  # user_id -> CollectState
+
+def set_collecting(user_id: int, mode: CollectMode, **data):
+    COLLECTING_MODE[user_id] = CollectState(mode, data, time.monotonic() + COLLECT_TIMEOUT)
+
+def get_collecting(user_id: int):
+    state = COLLECTING_MODE.get(user_id)
+    if state and state.expires_at < time.monotonic():
+        COLLECTING_MODE.pop(user_id, None)
+        return None
+    return state
+
+def clear_collecting(user_id: int):
+    COLLECTING_MODE.pop(user_id, None)
+
+# ============== ASSET INGESTION ==============
+# Albums and forwarded batches arrive as one update per item. Items are
+# buffered per (admin, type) and written with one INSERT once no new item has
+# arrived for INGEST_DEBOUNCE seconds, followed by a single summary message.
+INGEST_DEBOUNCE = 1.5
+INGEST_MAX_BATCH = 100
+INGEST_MAX_LIST_BYTES = 1024 * 1024
+FILE_ID_RE = re.compile(r"[A-Za-z0-9_-]{20,}")
+# Pasted file_ids are checked with getFile before they are stored; this many
+# are resolved at once, and this many failures are listed back to the admin
+INGEST_RESOLVE_CHUNK = 10
+INGEST_MAX_REPORTED = 10
+# getFile's file_path says what kind of file an ID points to
+ASSET_FILE_PATHS = {"pic": ("photos/", "documents/"), "sticker": ("stickers/",)}
+ASSET_INGEST = {}
+
+class AssetBatch:
+    def __init__(self, bot, chat_id: int, asset_type: str):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.asset_type = asset_type
+        self.items = {}  # file_unique_id (or file_id) -> (file_id, file_unique_id)
+        self.albums = set()
+        self.timer = None
+
+def queue_asset(bot, user_id: int, chat_id: int, asset_type: str, file_id: str,
+                file_unique_id: str = None, media_group_id: str = None):
+    key = (user_id, asset_type)
+    batch = ASSET_INGEST.get(key)
+    if batch is None:
+        batch = ASSET_INGEST[key] = AssetBatch(bot, chat_id, asset_type)
+    batch.items.setdefault(file_unique_id or file_id, (file_id, file_unique_id))
+    if media_group_id:
+        batch.albums.add(media_group_id)
+    if batch.timer:
+        batch.timer.cancel()
+    if len(batch.items) >= INGEST_MAX_BATCH:
+        batch.timer = None
+        fire_and_forget(flush_asset_batch(key))
+    else:
+        batch.timer = asyncio.create_task(_flush_asset_batch_later(key))
+
+async def _flush_asset_batch_later(key):
+    await asyncio.sleep(INGEST_DEBOUNCE)
+    await flush_asset_batch(key)
+
+async def flush_asset_batch(key):
+    batch = ASSET_INGEST.pop(key, None)
+    if batch is None:
+        return
+    if batch.timer and batch.timer is not asyncio.current_task():
+        batch.timer.cancel()
+    label = "pics" if batch.asset_type == "pic" else "stickers"
+    try:
+        added = await add_assets(batch.asset_type, list(batch.items.values()))
+    except Exception as e:
+        logger.error(f"Asset ingest error: {e}")
+        await batch.bot.send_message(chat_id=batch.chat_id, text=f"❌ {len(batch.items)} {label} save nahi ho paye, dobara bhejo.")
+        return
+    text = f"✅ {added} {label} added!"
+    if len(batch.items) > added:
+        text += f" ({len(batch.items) - added} duplicate skip)"
+    if batch.albums:
+        text += f" [{len(batch.albums)} album]"
+    await batch.bot.send_message(chat_id=batch.chat_id, text=f"{text}\nMore bhejo ya 'done' likho.")
+
+async def flush_user_assets(user_id: int):
+    for key in [k for k in ASSET_INGEST if k[0] == user_id]:
+        await flush_asset_batch(key)
+
+async def read_file_id_list(msg) -> list:
+    """file_ids pasted as text or uploaded as a .txt document, for bulk import."""
+    text = msg.text or ""
+    if msg.document and msg.document.mime_type == "text/plain":
+        if (msg.document.file_size or 0) > INGEST_MAX_LIST_BYTES:
+            return []
+        f = await msg.document.get_file()
+        text = bytes(await f.download_as_bytearray()).decode("utf-8", errors="ignore")
+    return FILE_ID_RE.findall(text)
+
+async def _resolve_file_id(bot, asset_type: str, file_id: str):
+    """Returns file_unique_id for a usable file_id of the right type, else None."""
+    try:
+        f = await bot.get_file(file_id, rate_limit_args=BULK)
+    except TelegramError as e:
+        # Flood waits and network errors that outlived the scheduler's retries
+        # count as failures too, so the import always finishes and reports
+        logger.info(f"Rejected file_id {file_id[:16]}...: {e}")
+        return None
+    if not (f.file_path or "").startswith(ASSET_FILE_PATHS[asset_type]):
+        return None
+    return f.file_unique_id
+
+async def import_file_ids(bot, user_id: int, chat_id: int, asset_type: str, file_ids: list):
+    """Bulk import runs in the background: validate each ID, queue the good ones, report the rest."""
+    failed = []
+    file_ids = list(dict.fromkeys(file_ids))
+    for i in range(0, len(file_ids), INGEST_RESOLVE_CHUNK):
+        chunk = file_ids[i:i + INGEST_RESOLVE_CHUNK]
+        resolved = await asyncio.gather(*(_resolve_file_id(bot, asset_type, f) for f in chunk))
+        for file_id, file_unique_id in zip(chunk, resolved):
+            if file_unique_id:
+                queue_asset(bot, user_id, chat_id, asset_type, file_id, file_unique_id)
+            else:
+                failed.append(file_id)
+    if failed:
+        label = "pic" if asset_type == "pic" else "sticker"
+        shown = "\n".join(f"`{f}`" for f in failed[:INGEST_MAX_REPORTED])
+        more = f"\n...aur {len(failed) - INGEST_MAX_REPORTED} more" if len(failed) > INGEST_MAX_REPORTED else ""
+        await bot.send_message(
+            chat_id=chat_id,
+            text=f"⚠️ {len(failed)} file IDs invalid ya {label} nahi hain, skip kiye:\n{shown}{more}",
+            parse_mode="Markdown",
+        )
+
+async def backfill_asset_unique_ids(bot):
+    """Resolve file_unique_id for assets stored before it was tracked.
+
+    NULLs don't collide in the unique index, so until this runs a re-upload of
+    an old picture is stored again. An old row that turns out to duplicate
+    another is removed; IDs that can't be resolved now stay NULL and are
+    retried on the next start.
+    """
+    pool = await get_db()
+    async with pool.acquire() as conn:
+        if not await conn.fetchval("SELECT pg_try_advisory_lock(hashtext('alya_asset_backfill'))"):
+            return  # another worker is on it
+        try:
+            rows = await conn.fetch(
+                "SELECT id, type, file_id FROM assets WHERE file_unique_id IS NULL AND type = ANY($1::text[]) ORDER BY id",
+                list(ASSET_FILE_PATHS),
+            )
+            resolved = removed = 0
+            for i in range(0, len(rows), INGEST_RESOLVE_CHUNK):
+                chunk = rows[i:i + INGEST_RESOLVE_CHUNK]
+                unique_ids = await asyncio.gather(*(_resolve_file_id(bot, r['type'], r['file_id']) for r in chunk))
+                for row, file_unique_id in zip(chunk, unique_ids):
+                    if not file_unique_id:
+                        continue
+                    try:
+                        await conn.execute("UPDATE assets SET file_unique_id=$2 WHERE id=$1", row['id'], file_unique_id)
+                        resolved += 1
+                    except asyncpg.UniqueViolationError:
+                        await conn.execute("DELETE FROM assets WHERE id=$1", row['id'])
+                        removed += 1
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock(hashtext('alya_asset_backfill'))")
+    if rows:
+        logger.info(f"Asset backfill: {resolved} resolved, {removed} duplicates removed, "
+                    f"{len(rows) - resolved - removed} unresolved")
+    if removed:
+        await invalidate_cache("assets")
 
 # ============== START COMMAND ==============
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -454,272 +1359,511 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await q.edit_message_text("❌ Action cancelled!")
         return
 
-# ============== MESSAGE HANDLER ==============
-async def chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    u = update.effective_user
-    msg = update.message
-    chat_type = update.effective_chat.type
+# ============== BACKUP / RESTORE ==============
+# Tables are streamed with COPY straight into (and out of) deflated CSV members
+# of a zip archive, so memory stays flat however many message rows there are.
+BACKUP_DIR = os.environ.get("BACKUP_DIR", "backups")
+BACKUP_TABLES = {
+    "users": ["user_id", "first_name", "username", "nickname", "started_at", "mood"],
+    "messages": ["id", "user_id", "role", "text", "ts"],
+    "assets": ["id", "type", "file_id", "file_unique_id"],
+    "admins": ["user_id", "added_by", "added_at"],
+    "blocked_users": ["user_id", "blocked_by", "blocked_at"],
+    "channels": ["id", "channel_id", "channel_link", "channel_name"],
+}
+# SERIAL ids only mean something inside the database that assigned them, so
+# these tables are restored with fresh ids (in backup order) rather than
+# colliding with rows this bot has already written. assets and channels are
+# deduplicated on their unique columns; messages have none, so a row is
+# skipped when an identical one is already present.
+SERIAL_TABLES = ("messages", "assets", "channels")
+MESSAGE_DEDUP = (
+    " WHERE NOT EXISTS (SELECT 1 FROM messages m WHERE m.user_id = s.user_id"
+    " AND m.ts = s.ts AND m.role = s.role AND m.text = s.text)"
+)
+TELEGRAM_UPLOAD_LIMIT = 50 * 1024 * 1024
+TELEGRAM_DOWNLOAD_LIMIT = 20 * 1024 * 1024
+
+async def export_data(path: str = None):
+    """Write every backup table to a zip archive; returns (path, {table: rows})."""
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    path = path or os.path.join(BACKUP_DIR, f"alya-backup-{datetime.now(timezone.utc):%Y%m%d-%H%M%S}.zip")
+    counts = {}
+    pool = await get_db()
+    try:
+        with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+            async with pool.acquire() as conn:
+                # One snapshot for all tables so messages and users stay consistent
+                async with conn.transaction(isolation="repeatable_read", readonly=True):
+                    for table, columns in BACKUP_TABLES.items():
+                        with zf.open(f"{table}.csv", "w", force_zip64=True) as out:
+                            status = await conn.copy_from_table(
+                                table, columns=columns, output=out, format="csv", header=True
+                            )
+                        counts[table] = int(status.split()[-1])
+    except Exception:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    return path, counts
+
+async def import_data(path: str):
+    """Restore a zip made by export_data(); rows whose key already exists are kept as-is."""
+    counts = {}
+    pool = await get_db()
+    with zipfile.ZipFile(path) as zf:
+        names = set(zf.namelist())
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                for table, columns in BACKUP_TABLES.items():
+                    if f"{table}.csv" not in names:
+                        continue
+                    fresh_ids = table in SERIAL_TABLES
+                    cols = ", ".join(c for c in columns if not (fresh_ids and c == "id"))
+                    staging = f"import_{table}"
+                    await conn.execute(f"CREATE TEMP TABLE {staging} (LIKE {table}) ON COMMIT DROP")
+                    with zf.open(f"{table}.csv") as src:
+                        await conn.copy_to_table(staging, source=src, columns=columns, format="csv", header=True)
+                    query = f"INSERT INTO {table} ({cols}) SELECT {cols} FROM {staging} s"
+                    if table == "messages":
+                        query += MESSAGE_DEDUP
+                    if fresh_ids:
+                        query += " ORDER BY s.id"
+                    status = await conn.execute(query + " ON CONFLICT DO NOTHING")
+                    counts[table] = int(status.split()[-1])
+    return counts
+
+def format_counts(counts: dict) -> str:
+    return "\n".join(f"• {table}: {n}" for table, n in counts.items())
+
+# Export/import can run for minutes on a big messages table, so they run as
+# background jobs instead of holding up update processing; one job at a time.
+_backup_job = None
+
+def start_backup_job(coro) -> bool:
+    global _backup_job
+    if _backup_job and not _backup_job.done():
+        coro.close()
+        return False
+    _backup_job = fire_and_forget(coro)
+    return True
 
-    if not msg or not u:
+async def run_export(msg):
+    try:
+        path, counts = await export_data()
+    except Exception as e:
+        logger.error(f"Export error: {e}")
+        await msg.reply_text(f"❌ Export failed: {e}")
         return
-
-    if await is_blocked(u.id):
+    summary = f"✅ Export done!\n{format_counts(counts)}"
+    if os.path.getsize(path) > TELEGRAM_UPLOAD_LIMIT:
+        await msg.reply_text(f"{summary}\n\nFile bahut badi hai Telegram ke liye, server par saved hai:\n{path}")
         return
+    delivered = False
+    try:
+        with open(path, "rb") as f:
+            await msg.reply_document(document=f, filename=os.path.basename(path), caption=summary)
+        delivered = True
+    except Exception as e:
+        # Includes timeouts the scheduler won't retry, so it may still arrive
+        logger.error(f"Export upload error: {e}")
+        await msg.reply_text(f"{summary}\n\n❌ File shayad nahi pahunchi ({e}), server par saved hai:\n{path}")
+    finally:
+        # A delivered backup isn't kept, it holds every user's messages; one
+        # that may not have arrived stays so the owner can still fetch it
+        if delivered:
+            os.remove(path)
+
+async def run_import(msg, path: str, from_upload: bool):
+    try:
+        if from_upload:
+            f = await msg.document.get_file()
+            await f.download_to_drive(path)
+        counts = await import_data(path)
+        await invalidate_cache(*CACHE_LOADERS)
+        await msg.reply_text(f"✅ Import done! New rows:\n{format_counts(counts)}")
+    except Exception as e:
+        logger.error(f"Import error: {e}")
+        await msg.reply_text(f"❌ Import failed: {e}")
+    finally:
+        if from_upload and os.path.exists(path):
+            os.remove(path)
 
-    user_text = msg.text.strip() if msg.text else ""
-
-    # === CLEAR MY DATA ===
-    if user_text == "🗑️ Clear My Data":
-        await msg.reply_text(
-            "Baby sach mein saari baatein bhool jaun? 🥺\n"
-            "Confirm karo please...",
-            reply_markup=get_confirmation_keyboard("clear_my_data")
-        )
+async def export_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    msg = update.message
+    if not await is_owner(update.effective_user.id):
         return
+    if not start_backup_job(run_export(msg)):
+        await msg.reply_text("⏳ Ek export/import pehle se chal raha hai, khatam hone do.")
+        return
+    await msg.reply_text("📦 Export shuru... ho jaane par file bhej dungi.")
 
-    # === OWNER/ADMIN BUTTONS ===
-    if await is_admin(u.id):
-        if user_text == "📊 Stats":
-            pool = await get_db()
-            async with pool.acquire() as conn:
-                rows = await conn.fetch("SELECT user_id, first_name, username, started_at FROM users ORDER BY started_at DESC")
-            lines = [f"📊 Total Users: {len(rows)}\n"]
-            for i, row in enumerate(rows[:50]):
-                uname = f"@{row['username']}" if row['username'] else "-"
-                lines.append(f"{i+1}. {row['first_name']} ({uname}) | `{row['user_id']}`")
-            if len(rows) > 50:
-                lines.append(f"\n...and {len(rows)-50} more")
-            await msg.reply_text("\n".join(lines), parse_mode="Markdown")
-            return
-
-        if user_text == "📢 Broadcast":
-            COLLECTING_MODE[u.id] = "broadcast"
-            await msg.reply_text("📢 Broadcast message bhejo. \nCancel karne ke liye 'cancel' likho.")
-            return
-
-        if user_text == "🖼️ Add Pics":
-            COLLECTING_MODE[u.id] = "pic"
-            await msg.reply_text("🖼️ Photos bhejo jo add karni hain.\n'done' likho band karne ke liye.")
+async def import_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/import <path on server>, or a backup zip uploaded with /import as caption."""
+    msg = update.message
+    if not await is_owner(update.effective_user.id):
+        return
+    from_upload = bool(msg.document)
+    if from_upload:
+        if (msg.document.file_size or 0) > TELEGRAM_DOWNLOAD_LIMIT:
+            await msg.reply_text("❌ Telegram se 20MB tak hi download hota hai. Server par file rakh ke /import <path> use karo.")
             return
+        fd, path = tempfile.mkstemp(suffix=".zip")
+        os.close(fd)
+    elif context.args:
+        path = " ".join(context.args)
+    else:
+        await msg.reply_text("Usage: /import <path> ya backup zip bhejo caption '/import' ke saath.")
+        return
+    if not start_backup_job(run_import(msg, path, from_upload)):
+        if from_upload:
+            os.remove(path)
+        await msg.reply_text("⏳ Ek export/import pehle se chal raha hai, khatam hone do.")
+        return
+    await msg.reply_text("📥 Import shuru... ho jaane par bata dungi.")
 
-        if user_text == "🎭 Add Stickers":
-            COLLECTING_MODE[u.id] = "sticker"
-            await msg.reply_text("🎭 Stickers bhejo jo add karne hain.\n'done' likho band karne ke liye.")
-            return
+# ============== BUTTON HANDLERS ==============
+async def btn_clear_my_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(
+        "Baby sach mein saari baatein bhool jaun? 🥺\n"
+        "Confirm karo please...",
+        reply_markup=get_confirmation_keyboard("clear_my_data")
+    )
 
-        if user_text == "📸 View Pics":
-            pics = await get_all_assets("pic")
-            if not pics:
-                await msg.reply_text("Koi pics saved nahi hain 😢")
-                return
-            await msg.reply_text(f"📸 Total {len(pics)} pics hain. Bhej rahi hoon...")
-            for pid in pics[:20]:
-                try:
-                    await context.bot.send_photo(chat_id=msg.chat_id, photo=pid)
-                except Exception:
-                    continue
-            return
+async def btn_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    pool = await get_db()
+    async with pool.acquire() as conn:
+        rows = await conn.fetch("SELECT user_id, first_name, username, started_at FROM users ORDER BY started_at DESC")
+    lines = [f"📊 Total Users: {len(rows)}\n"]
+    for i, row in enumerate(rows[:50]):
+        uname = f"@{row['username']}" if row['username'] else "-"
+        lines.append(f"{i+1}. {row['first_name']} ({uname}) | `{row['user_id']}`")
+    if len(rows) > 50:
+        lines.append(f"\n...and {len(rows)-50} more")
+    top = await get_top_usage()
+    if top:
+        lines.append("\n🔥 Top LLM users today:")
+        for i, row in enumerate(top):
+            avg_ms = row['latency_ms'] // max(row['requests'], 1)
+            lines.append(
+                f"{i+1}. {row['first_name'] or '-'} | `{row['user_id']}` | "
+                f"{row['total']} tok ({row['cached_tokens']} cached) | {row['requests']} req | {avg_ms}ms avg"
+            )
+    out = OUTBOUND.stats
+    lines.append(
+        f"\n📤 Outbound: {out['sent']} sent | {out['retried']} retried | "
+        f"{out['rate_limited']} flood waits | {out['failed']} failed | "
+        f"{out['unconfirmed']} unconfirmed | {out['dropped']} dropped"
+    )
+    await update.message.reply_text("\n".join(lines), parse_mode="Markdown")
 
-        if user_text == "🎪 View Stickers":
-            stickers = await get_all_assets("sticker")
-            if not stickers:
-                await msg.reply_text("Koi stickers saved nahi hain 😢")
-                return
-            await msg.reply_text(f"🎪 Total {len(stickers)} stickers hain. Bhej rahi hoon...")
-            for sid in stickers[:20]:
-                try:
-                    await context.bot.send_sticker(chat_id=msg.chat_id, sticker=sid)
-                except Exception:
-                    continue
-            return
+async def btn_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    set_collecting(update.effective_user.id, CollectMode.BROADCAST)
+    await update.message.reply_text("📢 Broadcast message bhejo. \nCancel karne ke liye 'cancel' likho.")
 
-        if user_text == "🚫 Block User":
-            COLLECTING_MODE[u.id] = "block"
-            await msg.reply_text("🚫 User ID bhejo jisko block karna hai:")
-            return
+async def btn_add_pics(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    set_collecting(update.effective_user.id, CollectMode.PIC)
+    await update.message.reply_text("🖼️ Photos bhejo jo add karni hain.\n'done' likho band karne ke liye.")
 
-        if user_text == "✅ Unblock User":
-            COLLECTING_MODE[u.id] = "unblock"
-            await msg.reply_text("✅ User ID bhejo jisko unblock karna hai:")
-            return
+async def btn_add_stickers(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    set_collecting(update.effective_user.id, CollectMode.STICKER)
+    await update.message.reply_text("🎭 Stickers bhejo jo add karne hain.\n'done' likho band karne ke liye.")
 
-        if user_text == "🗑️ Clear All Data":
-            await msg.reply_text(
-                "⚠️ DANGER! Sab data delete ho jayega:\n"
-                "- All users\n"
-                "- All messages\n"
-                "- All pics\n"
-                "- All stickers\n\n"
-                "Pakka delete karna hai?",
-                reply_markup=get_confirmation_keyboard("clear_all_data")
-            )
-            return
+async def btn_view_pics(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    msg = update.message
+    pics = await get_all_assets("pic")
+    if not pics:
+        await msg.reply_text("Koi pics saved nahi hain 😢")
+        return
+    await msg.reply_text(f"📸 Total {len(pics)} pics hain. Bhej rahi hoon...")
+    for pid in pics[:20]:
+        try:
+            await context.bot.send_photo(chat_id=msg.chat_id, photo=pid, rate_limit_args=BULK)
+        except Exception as e:
+            logger.warning(f"View pics send failed: {e}")
 
-    # === OWNER ONLY BUTTONS ===
-    if await is_owner(u.id):
-        if user_text == "➕ Add Admin":
-            COLLECTING_MODE[u.id] = "add_admin"
-            await msg.reply_text("➕ User ID bhejo jisko admin banana hai:")
-            return
+async def btn_view_stickers(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    msg = update.message
+    stickers = await get_all_assets("sticker")
+    if not stickers:
+        await msg.reply_text("Koi stickers saved nahi hain 😢")
+        return
+    await msg.reply_text(f"🎪 Total {len(stickers)} stickers hain. Bhej rahi hoon...")
+    for sid in stickers[:20]:
+        try:
+            await context.bot.send_sticker(chat_id=msg.chat_id, sticker=sid, rate_limit_args=BULK)
+        except Exception as e:
+            logger.warning(f"View stickers send failed: {e}")
 
-        if user_text == "➖ Remove Admin":
-            admins = await get_all_admins()
-            if not admins:
-                await msg.reply_text("Koi admin nahi hai abhi.")
-                return
-            COLLECTING_MODE[u.id] = "remove_admin"
-            admin_list = "\n".join([f"• `{a}`" for a in admins])
-            await msg.reply_text(f"Current Admins:\n{admin_list}\n\nUser ID bhejo jisko remove karna hai:", parse_mode="Markdown")
-            return
+async def btn_block_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    set_collecting(update.effective_user.id, CollectMode.BLOCK)
+    await update.message.reply_text("🚫 User ID bhejo jisko block karna hai:")
 
-        if user_text == "📺 Add Channel":
-            COLLECTING_MODE[u.id] = "add_channel_link"
-            await msg.reply_text("📺 Channel ka invite link bhejo (e.g., https://t.me/channel):")
-            return
+async def btn_unblock_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    set_collecting(update.effective_user.id, CollectMode.UNBLOCK)
+    await update.message.reply_text("✅ User ID bhejo jisko unblock karna hai:")
 
-        if user_text == "❌ Remove Channel":
-            channels = await get_all_channels()
-            if not channels:
-                await msg.reply_text("Koi channel set nahi hai abhi.")
-                return
-            COLLECTING_MODE[u.id] = "remove_channel"
-            ch_list = "\n".join([f"• {c['name']} | `{c['id']}`" for c in channels])
-            await msg.reply_text(f"Current Channels:\n{ch_list}\n\nChannel ID bhejo jisko remove karna hai:", parse_mode="Markdown")
-            return
+async def btn_clear_all_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(
+        "⚠️ DANGER! Sab data delete ho jayega:\n"
+        "- All users\n"
+        "- All messages\n"
+        "- All pics\n"
+        "- All stickers\n\n"
+        "Pakka delete karna hai? (Pehle /export se backup le lo)",
+        reply_markup=get_confirmation_keyboard("clear_all_data")
+    )
 
-    # ============== COLLECTING MODE HANDLERS ==============
-    if u.id in COLLECTING_MODE:
-        mode = COLLECTING_MODE[u.id]
+async def btn_add_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    set_collecting(update.effective_user.id, CollectMode.ADD_ADMIN)
+    await update.message.reply_text("➕ User ID bhejo jisko admin banana hai:")
 
-        if user_text.lower() == "cancel":
-            COLLECTING_MODE.pop(u.id, None)
-            await msg.reply_text("❌ Cancelled!")
-            return
+async def btn_remove_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    admins = await get_all_admins()
+    if not admins:
+        await update.message.reply_text("Koi admin nahi hai abhi.")
+        return
+    set_collecting(update.effective_user.id, CollectMode.REMOVE_ADMIN)
+    admin_list = "\n".join([f"• `{a}`" for a in admins])
+    await update.message.reply_text(f"Current Admins:\n{admin_list}\n\nUser ID bhejo jisko remove karna hai:", parse_mode="Markdown")
 
-        if user_text.lower() == "done":
-            m = COLLECTING_MODE.pop(u.id, None)
-            await msg.reply_text(f"✅ {m} collection done!")
-            return
+async def btn_add_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    set_collecting(update.effective_user.id, CollectMode.ADD_CHANNEL_LINK)
+    await update.message.reply_text("📺 Channel ka invite link bhejo (e.g., https://t.me/channel):")
 
-        if mode == "broadcast":
-            COLLECTING_MODE.pop(u.id, None)
-            pool = await get_db()
-            async with pool.acquire() as conn:
-                users = await conn.fetch("SELECT user_id FROM users")
-            success = 0
-            failed = 0
-            await msg.reply_text(f"📢 Broadcasting to {len(users)} users...")
-            for row in users:
-                try:
-                    await context.bot.send_message(chat_id=row['user_id'], text=user_text)
-                    success += 1
-                except Exception:
-                    failed += 1
-                await asyncio.sleep(0.05)
-            await msg.reply_text(f"✅ Broadcast complete!\n• Success: {success}\n• Failed: {failed}")
-            return
+async def btn_remove_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    channels = await get_all_channels()
+    if not channels:
+        await update.message.reply_text("Koi channel set nahi hai abhi.")
+        return
+    set_collecting(update.effective_user.id, CollectMode.REMOVE_CHANNEL)
+    ch_list = "\n".join([f"• {c['name']} | `{c['id']}`" for c in channels])
+    await update.message.reply_text(f"Current Channels:\n{ch_list}\n\nChannel ID bhejo jisko remove karna hai:", parse_mode="Markdown")
+
+USER_BUTTONS = {
+    "🗑️ Clear My Data": btn_clear_my_data,
+}
+ADMIN_BUTTONS = {
+    "📊 Stats": btn_stats,
+    "📢 Broadcast": btn_broadcast,
+    "🖼️ Add Pics": btn_add_pics,
+    "🎭 Add Stickers": btn_add_stickers,
+    "📸 View Pics": btn_view_pics,
+    "🎪 View Stickers": btn_view_stickers,
+    "🚫 Block User": btn_block_user,
+    "✅ Unblock User": btn_unblock_user,
+    "🗑️ Clear All Data": btn_clear_all_data,
+}
+OWNER_BUTTONS = {
+    "➕ Add Admin": btn_add_admin,
+    "➖ Remove Admin": btn_remove_admin,
+    "📺 Add Channel": btn_add_channel,
+    "❌ Remove Channel": btn_remove_channel,
+}
+BUTTON_TEXTS = frozenset(USER_BUTTONS) | frozenset(ADMIN_BUTTONS) | frozenset(OWNER_BUTTONS)
+
+# ============== COLLECTING MODE HANDLERS ==============
+BROADCAST_IN_FLIGHT = 30
+
+async def collect_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, state: CollectState, text: str):
+    clear_collecting(update.effective_user.id)
+    # Runs in the background so interactive replies keep flowing (and get
+    # priority over these bulk sends in the outbound scheduler)
+    fire_and_forget(run_broadcast(context.bot, update.message, text))
+
+async def run_broadcast(bot, msg, text: str):
+    pool = await get_db()
+    async with pool.acquire() as conn:
+        users = await conn.fetch("SELECT user_id FROM users")
+    await msg.reply_text(f"📢 Broadcasting to {len(users)} users...")
+    # Pacing is left to the outbound scheduler; keep a window of sends in flight
+    failed = 0
+    for i in range(0, len(users), BROADCAST_IN_FLIGHT):
+        results = await asyncio.gather(*(
+            bot.send_message(chat_id=row['user_id'], text=text, rate_limit_args=BULK)
+            for row in users[i:i + BROADCAST_IN_FLIGHT]
+        ), return_exceptions=True)
+        failed += sum(isinstance(r, Exception) for r in results)
+    await msg.reply_text(f"✅ Broadcast complete!\n• Success: {len(users) - failed}\n• Failed: {failed}")
+
+async def collect_asset(update: Update, context: ContextTypes.DEFAULT_TYPE, state: CollectState, text: str):
+    msg = update.message
+    u = update.effective_user
+    mode = state.mode.value
+    media = None
+    if state.mode is CollectMode.PIC and msg.photo:
+        media = msg.photo[-1]
+    elif state.mode is CollectMode.PIC and msg.document and msg.document.mime_type and msg.document.mime_type.startswith("image/"):
+        media = msg.document
+    elif state.mode is CollectMode.STICKER and msg.sticker:
+        media = msg.sticker
+    if media:
+        queue_asset(context.bot, u.id, msg.chat_id, mode, media.file_id,
+                    media.file_unique_id, msg.media_group_id)
+        return
+    file_ids = await read_file_id_list(msg)
+    if file_ids:
+        if len(file_ids) > INGEST_RESOLVE_CHUNK:
+            await msg.reply_text(f"🔍 {len(file_ids)} file IDs check kar rahi hoon...")
+        fire_and_forget(import_file_ids(context.bot, u.id, msg.chat_id, mode, file_ids))
 
-        if mode == "pic":
-            file_id = None
-            if msg.photo:
-                file_id = msg.photo[-1].file_id
-            elif msg.document and msg.document.mime_type and msg.document.mime_type.startswith("image/"):
-                file_id = msg.document.file_id
-            if file_id:
-                await add_asset("pic", file_id)
-                await msg.reply_text("✅ Pic added! More bhejo ya 'done' likho.")
+async def collect_block(update: Update, context: ContextTypes.DEFAULT_TYPE, state: CollectState, text: str):
+    msg = update.message
+    clear_collecting(update.effective_user.id)
+    try:
+        target_id = int(text)
+        if target_id == OWNER_ID:
+            await msg.reply_text("Owner ko block nahi kar sakte 😅")
             return
+        await block_user(target_id, update.effective_user.id)
+        await msg.reply_text(f"✅ User `{target_id}` blocked!", parse_mode="Markdown")
+    except ValueError:
+        await msg.reply_text("Invalid user ID!")
 
-        if mode == "sticker" and msg.sticker:
-            await add_asset("sticker", msg.sticker.file_id)
-            await msg.reply_text("✅ Sticker added! More bhejo ya 'done' likho.")
-            return
+async def collect_unblock(update: Update, context: ContextTypes.DEFAULT_TYPE, state: CollectState, text: str):
+    msg = update.message
+    clear_collecting(update.effective_user.id)
+    try:
+        target_id = int(text)
+        await unblock_user(target_id)
+        await msg.reply_text(f"✅ User `{target_id}` unblocked!", parse_mode="Markdown")
+    except ValueError:
+        await msg.reply_text("Invalid user ID!")
 
-        if mode == "block":
-            COLLECTING_MODE.pop(u.id, None)
-            try:
-                target_id = int(user_text)
-                if target_id == OWNER_ID:
-                    await msg.reply_text("Owner ko block nahi kar sakte 😅")
-                    return
-                await block_user(target_id, u.id)
-                await msg.reply_text(f"✅ User `{target_id}` blocked!", parse_mode="Markdown")
-            except ValueError:
-                await msg.reply_text("Invalid user ID!")
-            return
+async def collect_add_admin(update: Update, context: ContextTypes.DEFAULT_TYPE, state: CollectState, text: str):
+    msg = update.message
+    clear_collecting(update.effective_user.id)
+    try:
+        target_id = int(text)
+        await add_admin(target_id, update.effective_user.id)
+        await msg.reply_text(f"✅ User `{target_id}` is now admin!", parse_mode="Markdown")
+        try:
+            await context.bot.send_message(
+                chat_id=target_id,
+                text="🎉 Congratulations! 🎉\n\n"
+                     "Tumhe Admin promote kar diya gaya hai! 💫\n"
+                     "Ab tum bot manage kar sakte ho.\n\n"
+                     "/start dabao apna admin panel dekhne ke liye 👑",
+                reply_markup=get_admin_keyboard()
+            )
+        except Exception as e:
+            logger.warning(f"Admin promotion notice to {target_id} failed: {e}")
+    except ValueError:
+        await msg.reply_text("Invalid user ID!")
 
-        if mode == "unblock":
-            COLLECTING_MODE.pop(u.id, None)
-            try:
-                target_id = int(user_text)
-                await unblock_user(target_id)
-                await msg.reply_text(f"✅ User `{target_id}` unblocked!", parse_mode="Markdown")
-            except ValueError:
-                await msg.reply_text("Invalid user ID!")
-            return
+async def collect_remove_admin(update: Update, context: ContextTypes.DEFAULT_TYPE, state: CollectState, text: str):
+    msg = update.message
+    clear_collecting(update.effective_user.id)
+    try:
+        target_id = int(text)
+        await remove_admin(target_id)
+        await msg.reply_text(f"✅ User `{target_id}` removed from admins!", parse_mode="Markdown")
+    except ValueError:
+        await msg.reply_text("Invalid user ID!")
+
+async def collect_channel_link(update: Update, context: ContextTypes.DEFAULT_TYPE, state: CollectState, text: str):
+    set_collecting(update.effective_user.id, CollectMode.ADD_CHANNEL_ID, link=text)
+    await update.message.reply_text("Ab channel ID bhejo (e.g., -1001234567890 ya @channelname):")
+
+async def collect_channel_id(update: Update, context: ContextTypes.DEFAULT_TYPE, state: CollectState, text: str):
+    set_collecting(update.effective_user.id, CollectMode.ADD_CHANNEL_NAME, link=state.data["link"], channel_id=text)
+    await update.message.reply_text("Channel ka display name bhejo (e.g., My Channel):")
+
+async def collect_channel_name(update: Update, context: ContextTypes.DEFAULT_TYPE, state: CollectState, text: str):
+    clear_collecting(update.effective_user.id)
+    channel_id = state.data["channel_id"]
+    await add_channel(channel_id, state.data["link"], text)
+    await update.message.reply_text(f"✅ Channel added!\n• Name: {text}\n• ID: `{channel_id}`", parse_mode="Markdown")
+
+async def collect_remove_channel(update: Update, context: ContextTypes.DEFAULT_TYPE, state: CollectState, text: str):
+    clear_collecting(update.effective_user.id)
+    await remove_channel(text)
+    await update.message.reply_text(f"✅ Channel `{text}` removed!", parse_mode="Markdown")
+
+COLLECT_HANDLERS = {
+    CollectMode.BROADCAST: collect_broadcast,
+    CollectMode.PIC: collect_asset,
+    CollectMode.STICKER: collect_asset,
+    CollectMode.BLOCK: collect_block,
+    CollectMode.UNBLOCK: collect_unblock,
+    CollectMode.ADD_ADMIN: collect_add_admin,
+    CollectMode.REMOVE_ADMIN: collect_remove_admin,
+    CollectMode.ADD_CHANNEL_LINK: collect_channel_link,
+    CollectMode.ADD_CHANNEL_ID: collect_channel_id,
+    CollectMode.ADD_CHANNEL_NAME: collect_channel_name,
+    CollectMode.REMOVE_CHANNEL: collect_remove_channel,
+}
+
+# ============== MESSAGE ROUTER ==============
+async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Reply-keyboard buttons. The only place role checks run for message updates."""
+    u = update.effective_user
+    msg = update.message
+    if not msg or not u:
+        return
+    if await is_blocked(u.id):
+        return
 
-        if mode == "add_admin":
-            COLLECTING_MODE.pop(u.id, None)
-            try:
-                target_id = int(user_text)
-                await add_admin(target_id, u.id)
-                await msg.reply_text(f"✅ User `{target_id}` is now admin!", parse_mode="Markdown")
-                try:
-                    await context.bot.send_message(
-                        chat_id=target_id,
-                        text="🎉 Congratulations! 🎉\n\n"
-                             "Tumhe Admin promote kar diya gaya hai! 💫\n"
-                             "Ab tum bot manage kar sakte ho.\n\n"
-                             "/start dabao apna admin panel dekhne ke liye 👑",
-                        reply_markup=get_admin_keyboard()
-                    )
-                except Exception:
-                    pass
-            except ValueError:
-                await msg.reply_text("Invalid user ID!")
-            return
+    text = msg.text.strip()
+    handler = USER_BUTTONS.get(text)
+    if handler is None:
+        if text in OWNER_BUTTONS and await is_owner(u.id):
+            handler = OWNER_BUTTONS[text]
+        elif text in ADMIN_BUTTONS and await is_admin(u.id):
+            handler = ADMIN_BUTTONS[text]
+    if handler is None:
+        # Not allowed for this user - treat it like any other message
+        await route_message(update, context)
+        return
+    await handler(update, context)
 
-        if mode == "remove_admin":
-            COLLECTING_MODE.pop(u.id, None)
-            try:
-                target_id = int(user_text)
-                await remove_admin(target_id)
-                await msg.reply_text(f"✅ User `{target_id}` removed from admins!", parse_mode="Markdown")
-            except ValueError:
-                await msg.reply_text("Invalid user ID!")
-            return
+async def chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    u = update.effective_user
+    msg = update.message
+    if not msg or not u:
+        return
+    if await is_blocked(u.id):
+        return
+    await route_message(update, context)
 
-        if mode == "add_channel_link":
-            COLLECTING_MODE[u.id] = ("add_channel_id", user_text)
-            await msg.reply_text("Ab channel ID bhejo (e.g., -1001234567890 ya @channelname):")
-            return
+async def route_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    u = update.effective_user
+    state = get_collecting(u.id)
+    if state is None:
+        await alya_reply(update, context)
+        return
 
-        if isinstance(mode, tuple) and mode[0] == "add_channel_id":
-            channel_link = mode[1]
-            channel_id = user_text
-            COLLECTING_MODE[u.id] = ("add_channel_name", channel_link, channel_id)
-            await msg.reply_text("Channel ka display name bhejo (e.g., My Channel):")
-            return
+    msg = update.message
+    user_text = msg.text.strip() if msg.text else ""
+    if user_text.lower() == "cancel":
+        clear_collecting(u.id)
+        await flush_user_assets(u.id)
+        await msg.reply_text("❌ Cancelled!")
+        return
+    if user_text.lower() == "done":
+        clear_collecting(u.id)
+        await flush_user_assets(u.id)
+        await msg.reply_text(f"✅ {state.mode.value} collection done!")
+        return
 
-        if isinstance(mode, tuple) and mode[0] == "add_channel_name":
-            channel_link = mode[1]
-            channel_id = mode[2]
-            channel_name = user_text
-            COLLECTING_MODE.pop(u.id, None)
-            await add_channel(channel_id, channel_link, channel_name)
-            await msg.reply_text(f"✅ Channel added!\n• Name: {channel_name}\n• ID: `{channel_id}`", parse_mode="Markdown")
-            return
+    state.expires_at = time.monotonic() + COLLECT_TIMEOUT
+    await COLLECT_HANDLERS[state.mode](update, context, state, user_text)
 
-        if mode == "remove_channel":
-            COLLECTING_MODE.pop(u.id, None)
-            await remove_channel(user_text)
-            await msg.reply_text(f"✅ Channel `{user_text}` removed!", parse_mode="Markdown")
-            return
+# ============== ALYA AI CHAT ==============
+async def alya_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    u = update.effective_user
+    msg = update.message
+    chat_type = update.effective_chat.type
+    user_text = msg.text.strip() if msg.text else ""
 
-    # ============== GROUP CHAT LOGIC ==============
-    if chat_type in ("group", "supergroup"):
-        me = await context.bot.get_me()
-        bot_username = me.username or ""
+    # === GROUP CHAT - ONLY WHEN MENTIONED ===
+    is_group = chat_type in ("group", "supergroup")
+    if is_group:
+        if msg.sticker:
+            GROUP_CONTEXT.add(msg.chat_id, u.first_name or "Someone", f"[sticker {msg.sticker.emoji or ''}]")
+        elif user_text or msg.photo:
+            GROUP_CONTEXT.add(msg.chat_id, u.first_name or "Someone", user_text or "[photo]")
+        bot_username = context.bot.username or ""
         mentioned = False
         if re.search(r"\balya\b", user_text, flags=re.IGNORECASE):
             mentioned = True
@@ -728,27 +1872,25 @@ async def chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
         is_reply_to_bot = (
             msg.reply_to_message is not None
             and msg.reply_to_message.from_user is not None
-            and msg.reply_to_message.from_user.id == me.id
+            and msg.reply_to_message.from_user.id == context.bot.id
         )
         if not (mentioned or is_reply_to_bot):
             return
 
-    # ============== PRIVATE CHAT - CHANNEL CHECK ==============
+    # === PRIVATE CHAT - CHANNEL CHECK ===
     if chat_type == "private":
-        if not await is_owner(u.id) and not await is_admin(u.id):
-            channels = await get_all_channels()
-            if channels:
-                joined = await is_joined_all_channels(context.bot, u.id)
-                if not joined:
-                    channel_kb = await get_channel_buttons()
-                    await msg.reply_text(
-                        "Baby pehle channels join karo na 🥺\n"
-                        "Plz plz plz... meri baat maan lo 💕",
-                        reply_markup=channel_kb
-                    )
-                    return
-
-    # ============== ALYA AI CHAT ==============
+        channels = await get_all_channels()
+        if channels and not await is_admin(u.id):
+            joined = await is_joined_all_channels(context.bot, u.id)
+            if not joined:
+                channel_kb = await get_channel_buttons()
+                await msg.reply_text(
+                    "Baby pehle channels join karo na 🥺\n"
+                    "Plz plz plz... meri baat maan lo 💕",
+                    reply_markup=channel_kb
+                )
+                return
+
     is_sticker = bool(msg.sticker)
     if is_sticker:
         user_text = f"[User sent a sticker: {msg.sticker.emoji or 'unknown'}]"
@@ -756,72 +1898,124 @@ async def chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not user_text and not is_sticker:
         return
 
-    await context.bot.send_chat_action(chat_id=msg.chat_id, action=ChatAction.TYPING)
+    plan = await get_quota_plan(u.id)
+    if plan is None:
+        await msg.reply_text("Baby aaj bahut baatein ho gayi 🥺 Kal phir milte hain na 💕")
+        return
+    model, history_limit = plan
 
-    if chat_type == "private":
-        await log_msg(u.id, "user", user_text)
+    typing_task = asyncio.create_task(keep_typing(context.bot, msg.chat_id))
 
     pic_triggers = ["pic", "photo", "selfie", "dekhna", "dikha", "show me", "send pic", "apni pic", "tumhari pic", "face", "cute pic"]
     trigger_detected = any(t in user_text.lower() for t in pic_triggers)
 
-    nickname = await get_user_nickname(u.id)
-    history = await get_history(u.id)
-
-    messages = [{"role": "system", "content": ALYA_SYSTEM_PROMPT}]
-
-    context_info = f"User's name/nickname: {nickname}. "
-    if chat_type != "private":
-        context_info += "This is a GROUP chat. Keep replies short. "
-    else:
-        context_info += "This is PRIVATE DM. You can be more intimate. "
-
-    if is_sticker:
-        context_info += "User sent a sticker. You may respond with [SEND_STICKER] tag. "
-    if trigger_detected:
-        context_info += "User is asking for your photo. Include [SEND_PHOTO] in response. "
-
-    messages.append({"role": "system", "content": context_info})
-    messages.extend(history)
-
-    if not history or history[-1].get("content") != user_text:
-        messages.append({"role": "user", "content": user_text})
+    # Asset lookups don't depend on the reply, so they overlap with the LLM call
+    pic_task = asyncio.create_task(get_random_asset("pic")) if trigger_detected else None
+    sticker_task = asyncio.create_task(get_random_asset("sticker")) if is_sticker else None
 
     try:
-        response = await client.chat.completions.create(
-            model="llama-3.3-70b-versatile",
-            messages=messages,
-            max_completion_tokens=300,
-            temperature=0.85,
-        )
-        reply = response.choices[0].message.content
-    except Exception as e:
-        logger.error(f"AI Error: {e}")
-        reply = f"Arey {nickname}... network issue hai baby 😢 Thodi der baad try karo na 💕"
+        lookups = [get_user_nickname(u.id)]
+        # Facts, history and memories come from private chats and must not
+        # leak into a group reply
+        if not is_group:
+            lookups.append(get_user_facts(u.id))
+            lookups.append(get_history(u.id, history_limit))
+            lookups.append(recall_memories(u.id, user_text, history_limit))
+            lookups.append(log_msg(u.id, "user", user_text))
+            maybe_extract_facts(u.id)
+        nickname, *rest = await asyncio.gather(*lookups)
+        facts, history, memories = (rest[0], rest[1], rest[2]) if rest else ({}, [], [])
+
+        messages = [{"role": "system", "content": ALYA_SYSTEM_PROMPT}]
+
+        context_info = f"User's name/nickname: {nickname}. "
+        context_info += format_facts(facts)
+        if chat_type != "private":
+            context_info += "This is a GROUP chat. Keep replies short. "
+        else:
+            context_info += "This is PRIVATE DM. You can be more intimate. "
+
+        if is_sticker:
+            context_info += "User sent a sticker. You may respond with [SEND_STICKER] tag. "
+        if trigger_detected:
+            context_info += "User is asking for your photo. Include [SEND_PHOTO] in response. "
+
+        messages.append({"role": "system", "content": context_info})
+        if is_group:
+            # The mention itself is the last buffered item and goes in as the user turn
+            earlier = GROUP_CONTEXT.recent(msg.chat_id, GROUP_CONTEXT_WINDOW + 1)[:-1]
+            if earlier:
+                messages.append({"role": "system", "content": format_group_context(earlier)})
+        if memories:
+            messages.append({"role": "system", "content": format_memories(memories)})
+        messages.extend(history)
+
+        if not history or history[-1].get("content") != user_text:
+            messages.append({"role": "user", "content": user_text})
+
+        try:
+            started = time.perf_counter()
+            response = await get_llm().chat.completions.create(
+                model=model,
+                messages=messages,
+                max_completion_tokens=300,
+                temperature=0.85,
+            )
+            record_usage(u.id, response.usage, (time.perf_counter() - started) * 1000)
+            reply = response.choices[0].message.content
+        except Exception as e:
+            logger.error(f"AI Error: {e}")
+            reply = f"Arey {nickname}... network issue hai baby 😢 Thodi der baad try karo na 💕"
+    finally:
+        typing_task.cancel()
 
     send_photo = "[SEND_PHOTO]" in reply or trigger_detected
     send_sticker = "[SEND_STICKER]" in reply and is_sticker
 
     clean_reply = reply.replace("[SEND_PHOTO]", "").replace("[SEND_STICKER]", "").strip()
 
-    if chat_type == "private":
-        await log_msg(u.id, "assistant", clean_reply)
+    if is_group:
+        if clean_reply:
+            GROUP_CONTEXT.add(msg.chat_id, "Alya", clean_reply)
+    else:
+        fire_and_forget(log_msg(u.id, "assistant", clean_reply))
 
+    sends = []
     if clean_reply:
-        await msg.reply_text(clean_reply)
-
+        sends.append(msg.reply_text(clean_reply))
     if send_photo:
-        pid = await get_random_asset("pic")
-        if pid:
-            await context.bot.send_photo(chat_id=msg.chat_id, photo=pid)
-
+        sends.append(send_random_asset(context.bot, msg.chat_id, "pic", pic_task))
+    elif pic_task:
+        pic_task.cancel()
     if send_sticker:
-        sid = await get_random_asset("sticker")
-        if sid:
-            await context.bot.send_sticker(chat_id=msg.chat_id, sticker=sid)
+        sends.append(send_random_asset(context.bot, msg.chat_id, "sticker", sticker_task))
+    elif sticker_task:
+        sticker_task.cancel()
+
+    for result in await asyncio.gather(*sends, return_exceptions=True):
+        if isinstance(result, Exception):
+            logger.error(f"Reply send error: {result}")
 
 # ============== HEALTH CHECK SERVER ==============
+# "/" is liveness and answers as soon as the process is up. "/ready" turns 200
+# only once the DB, caches and bot are warm and updates are being received.
+READY = threading.Event()
+
 class HealthCheckHandler(BaseHTTPRequestHandler):
     def do_GET(self):
+        if self.path == "/ready":
+            ready = WORKER_POOL.is_ready() if WORKER_POOL else READY.is_set()
+            self.send_response(200 if ready else 503)
+            self.end_headers()
+            self.wfile.write(b"READY" if ready else b"STARTING")
+            return
+        if self.path == "/workers" and WORKER_POOL:
+            workers = WORKER_POOL.status()
+            self.send_response(200 if all(w["healthy"] for w in workers) else 503)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(json.dumps(workers).encode())
+            return
         self.send_response(200)
         self.end_headers()
         self.wfile.write(b"OK")
@@ -835,49 +2029,384 @@ def run_health_check():
     logger.info(f"Health check server on port {port}")
     server.serve_forever()
 
+# ============== APPLICATION SETUP ==============
+def _elapsed_ms(started: float) -> int:
+    return round((time.perf_counter() - started) * 1000)
+
+def format_timings(timings: dict) -> str:
+    return ", ".join(f"{phase} {ms}ms" for phase, ms in timings.items())
+
+async def start_services(app: Application, timings: dict, maintenance: bool = True):
+    """Bring up DB, caches, LLM client and bot identity, overlapping independent steps.
+
+    Per-phase wall times (ms) are recorded into `timings`. With `maintenance`,
+    slow DB upkeep (message index builds, asset backfill) is started in the background.
+    """
+    async def prepare_db():
+        started = time.perf_counter()
+        await init_db_pool()
+        timings["db_pool"] = _elapsed_ms(started)
+        started = time.perf_counter()
+        await init_db()
+        timings["schema"] = _elapsed_ms(started)
+        started = time.perf_counter()
+        await asyncio.gather(warm_caches(), start_cache_listener())
+        timings["caches"] = _elapsed_ms(started)
+
+    async def prepare_bot():
+        started = time.perf_counter()
+        await app.initialize()  # fetches the bot's identity via get_me
+        timings["bot_init"] = _elapsed_ms(started)
+
+    async def prepare_llm():
+        started = time.perf_counter()
+        await asyncio.to_thread(get_llm)
+        timings["llm_client"] = _elapsed_ms(started)
+
+    await asyncio.gather(prepare_db(), prepare_bot(), prepare_llm())
+    fire_and_forget(usage_flush_loop())
+    fire_and_forget(cache_reload_loop())
+    if maintenance:
+        fire_and_forget(build_message_indexes())
+        fire_and_forget(backfill_asset_unique_ids(app.bot))
+
+def build_application(with_updater: bool = True) -> Application:
+    from telegram.ext import (
+        Application,
+        BaseRateLimiter,
+        CommandHandler,
+        CallbackQueryHandler,
+        MessageHandler,
+        filters,
+    )
+
+    BaseRateLimiter.register(OutboundScheduler)
+    builder = Application.builder().token(BOT_TOKEN).rate_limiter(OUTBOUND)
+    if not with_updater:
+        builder = builder.updater(None)
+    app = builder.build()
+
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("export", export_cmd))
+    app.add_handler(CommandHandler("import", import_cmd))
+    app.add_handler(MessageHandler(filters.Document.ALL & filters.CaptionRegex(r"^/import\b"), import_cmd))
+    app.add_handler(CallbackQueryHandler(on_callback))
+    app.add_handler(MessageHandler(filters.Text(BUTTON_TEXTS) & ~filters.COMMAND, on_button))
+    app.add_handler(MessageHandler(
+        (filters.TEXT | filters.PHOTO | filters.Sticker.ALL | filters.Document.IMAGE | filters.Document.TXT) & ~filters.COMMAND,
+        chat
+    ))
+    return app
+
+# ============== MULTI-WORKER MODE ==============
+# With WORKERS > 1 the main process only long-polls Telegram and hands each raw
+# update to worker (chat id % WORKERS). Every worker is a full bot - its own
+# asyncpg pool, LLM client and PTB Application - that processes its queue in
+# order, so per-chat ordering holds and per-chat in-memory state (collecting
+# mode, asset batches) lives in exactly one process. A user's chats may land on
+# different workers; quota totals are re-read from llm_usage after every usage
+# flush, so other workers' usage is seen within USAGE_FLUSH_INTERVAL seconds.
+WORKER_HEARTBEAT = 5
+WORKER_STALE_AFTER = 30
+POLL_TIMEOUT = 30
+WORKER_POOL = None
+
+def shard_key(data: dict) -> int:
+    """Chat id of a raw update (falling back to user id, then update id)."""
+    for obj in data.values():
+        if not isinstance(obj, dict):
+            continue
+        chat = obj.get("chat") or (obj.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        user = obj.get("from") or obj.get("user")
+        if user:
+            return user["id"]
+    return data["update_id"]
+
+def worker_entry(index: int, queue, heartbeats, processed, ready):
+    # Ctrl+C reaches the whole process group; the front process stops workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(run_worker(index, queue, heartbeats, processed, ready))
+
+async def run_worker(index: int, queue, heartbeats, processed, ready):
+    async def heartbeat():
+        while True:
+            heartbeats[index] = time.time()
+            await asyncio.sleep(WORKER_HEARTBEAT)
+
+    # Beats during startup too, so a slow boot isn't mistaken for a stuck worker
+    beat = asyncio.create_task(heartbeat())
+    started = time.perf_counter()
+    timings = {}
+    app = build_application(with_updater=False)
+    await start_services(app, timings)
+    await app.start()
+    ready[index] = 1
+    timings["total"] = _elapsed_ms(started)
+    logger.info(f"Worker {index} ready (pid {os.getpid()}). Startup: {format_timings(timings)}")
+    loop = asyncio.get_running_loop()
+    while True:
+        data = await loop.run_in_executor(None, queue.get)
+        if data is None:
+            break
+        await app.update_queue.put(Update.de_json(data, app.bot))
+        processed[index] += 1
+    beat.cancel()
+    await shutdown(app)
+
+class WorkerPool:
+    def __init__(self, size: int):
+        self.ctx = multiprocessing.get_context("spawn")
+        self.size = size
+        self.queues = [self.ctx.Queue() for _ in range(size)]
+        self.heartbeats = self.ctx.Array("d", size, lock=False)
+        self.processed = self.ctx.Array("q", size, lock=False)
+        self.ready = self.ctx.Array("b", size, lock=False)
+        self.procs = [None] * size
+        self.restarts = [0] * size
+
+    def start(self, index: int):
+        self.heartbeats[index] = time.time()
+        self.ready[index] = 0
+        proc = self.ctx.Process(
+            target=worker_entry,
+            args=(index, self.queues[index], self.heartbeats, self.processed, self.ready),
+            name=f"alya-worker-{index}",
+            daemon=True,
+        )
+        proc.start()
+        self.procs[index] = proc
+
+    def start_all(self):
+        for i in range(self.size):
+            self.start(i)
+
+    def dispatch(self, data: dict):
+        self.queues[shard_key(data) % self.size].put(data)
+
+    def supervise(self):
+        now = time.time()
+        for i, proc in enumerate(self.procs):
+            if not proc.is_alive():
+                logger.warning(f"Worker {i} died (exit code {proc.exitcode}), restarting")
+            elif now - self.heartbeats[i] > WORKER_STALE_AFTER:
+                # Its event loop is blocked: nothing in its shard gets answered
+                # and its queue only grows
+                logger.warning(f"Worker {i} stuck (no heartbeat for {now - self.heartbeats[i]:.0f}s), restarting")
+                proc.terminate()
+                proc.join(1)
+                if proc.is_alive():
+                    proc.kill()
+                    proc.join()
+            else:
+                continue
+            self.replace_queue(i)
+            self.restarts[i] += 1
+            self.start(i)
+
+    def replace_queue(self, index: int):
+        """A worker killed mid-get can leave its queue's read lock held forever,
+        so the replacement reads from a fresh queue; whatever can still be read
+        from the old one is carried over."""
+        old = self.queues[index]
+        new = self.queues[index] = self.ctx.Queue()
+        while True:
+            try:
+                new.put(old.get_nowait())
+            except Empty:
+                break
+        old.close()
+        old.cancel_join_thread()
+
+    def is_ready(self) -> bool:
+        return all(self.ready) and all(proc.is_alive() for proc in self.procs)
+
+    def status(self):
+        now = time.time()
+        return [
+            {
+                "worker": i,
+                "pid": proc.pid,
+                "alive": proc.is_alive(),
+                "ready": bool(self.ready[i]),
+                "healthy": proc.is_alive() and now - self.heartbeats[i] < WORKER_STALE_AFTER,
+                "last_heartbeat_s": round(now - self.heartbeats[i], 1),
+                "processed": self.processed[i],
+                "restarts": self.restarts[i],
+            }
+            for i, proc in enumerate(self.procs)
+        ]
+
+    def stop(self, timeout: float = 30):
+        for q in self.queues:
+            q.put(None)
+        deadline = time.time() + timeout
+        for proc in self.procs:
+            proc.join(max(deadline - time.time(), 0))
+            if proc.is_alive():
+                proc.terminate()
+
+async def _wait_or_stop(stop: asyncio.Event, seconds: float):
+    try:
+        await asyncio.wait_for(stop.wait(), seconds)
+    except asyncio.TimeoutError:
+        pass
+
+async def poll_updates(pool: WorkerPool, stop: asyncio.Event):
+    api = f"https://api.telegram.org/bot{BOT_TOKEN}"
+    offset = None
+    async with httpx.AsyncClient(timeout=POLL_TIMEOUT + 10) as http:
+        try:
+            await http.post(f"{api}/deleteWebhook")
+        except httpx.HTTPError as e:
+            logger.warning(f"deleteWebhook failed: {e}")
+        stopping = asyncio.create_task(stop.wait())
+        while not stop.is_set():
+            request = asyncio.create_task(http.post(f"{api}/getUpdates", json={
+                "offset": offset,
+                "timeout": POLL_TIMEOUT,
+                "allowed_updates": Update.ALL_TYPES,
+            }))
+            await asyncio.wait({request, stopping}, return_when=asyncio.FIRST_COMPLETED)
+            if not request.done():
+                # Nothing from this poll was dispatched, so Telegram keeps it for next start
+                request.cancel()
+                break
+            try:
+                data = request.result().json()
+            except (httpx.HTTPError, ValueError) as e:
+                logger.warning(f"Polling error: {e}")
+                await _wait_or_stop(stop, 3)
+                continue
+            if not data.get("ok"):
+                retry_after = (data.get("parameters") or {}).get("retry_after", 5)
+                logger.warning(f"getUpdates failed: {data.get('description')}")
+                await _wait_or_stop(stop, retry_after)
+                continue
+            for update in data["result"]:
+                offset = update["update_id"] + 1
+                pool.dispatch(update)
+        stopping.cancel()
+        if offset is None:
+            return
+        # Telegram only forgets updates once a later offset is requested. Confirm
+        # the dispatched ones, as PTB's Updater does on stop, or the last batch
+        # is delivered again (and answered twice) after a restart.
+        try:
+            await http.post(f"{api}/getUpdates", json={"offset": offset, "timeout": 0, "limit": 1})
+        except httpx.HTTPError as e:
+            logger.warning(f"Final getUpdates failed, last updates may be redelivered: {e}")
+
+async def run_front():
+    global WORKER_POOL
+    pool = WORKER_POOL = WorkerPool(WORKERS)
+    pool.start_all()
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    poller = asyncio.create_task(poll_updates(pool, stop))
+    logger.info(f"Front process polling for {WORKERS} workers")
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), WORKER_HEARTBEAT)
+        except asyncio.TimeoutError:
+            pool.supervise()
+
+    logger.info("Shutting down workers...")
+    await poller
+    await loop.run_in_executor(None, pool.stop)
+    logger.info("Shutdown complete")
+
 # ============== GRACEFUL SHUTDOWN ==============
 async def shutdown(app: Application):
     logger.info("Shutting down...")
-    await app.updater.stop()
-    await app.stop()
+    if app.updater and app.updater.running:
+        await app.updater.stop()
+    if app.running:
+        await app.stop()
     await app.shutdown()
+    global _cache_listener
+    listener, _cache_listener = _cache_listener, None
+    if listener:
+        await listener.close()
     if db_pool:
+        try:
+            await flush_usage()
+        except Exception as e:
+            logger.error(f"Usage flush error: {e}")
         await db_pool.close()
     logger.info("Shutdown complete")
 
 # ============== MAIN ==============
 async def main():
+    started = time.perf_counter()
     if not BOT_TOKEN:
         raise RuntimeError("BOT_TOKEN missing!")
     if not DATABASE_URL:
         raise RuntimeError("DATABASE_URL missing!")
 
-    await init_db_pool()
-    await init_db()
-
     threading.Thread(target=run_health_check, daemon=True).start()
 
-    app = Application.builder().token(BOT_TOKEN).build()
+    if WORKERS > 1:
+        await run_front()
+        return
 
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CallbackQueryHandler(on_callback))
-    app.add_handler(MessageHandler(
-        (filters.TEXT | filters.PHOTO | filters.Sticker.ALL | filters.Document.IMAGE) & ~filters.COMMAND,
-        chat
-    ))
+    timings = {}
+    app = build_application()
+    await start_services(app, timings)
 
     loop = asyncio.get_event_loop()
     for sig in (signal.SIGINT, signal.SIGTERM):
         loop.add_signal_handler(sig, lambda: asyncio.create_task(shutdown(app)))
 
-    await app.initialize()
     await app.start()
     await app.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+    READY.set()
+    timings["total"] = _elapsed_ms(started)
 
-    logger.info("Bot started successfully!")
+    logger.info(f"Bot started successfully! Startup: {format_timings(timings)}")
 
     while True:
         await asyncio.sleep(3600)
 
+# ============== STARTUP BENCHMARK ==============
+async def bench_startup(runs: int):
+    """python main.py --bench-startup [runs]
+
+    Times a cold `import main` in a fresh interpreter and each start_services()
+    phase against the configured DB and bot token (no polling is started).
+    The first run pays for lazy imports and, on a fresh DB, the schema DDL.
+    """
+    global _llm_client
+    results = {}
+    here = os.path.dirname(os.path.abspath(__file__))
+    probe = "import time; t = time.perf_counter(); import main; print((time.perf_counter() - t) * 1000)"
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", probe], cwd=here, check=True, capture_output=True, text=True)
+        results.setdefault("import", []).append(round(float(out.stdout.strip().splitlines()[-1])))
+
+    for _ in range(runs):
+        _llm_client = None
+        started = time.perf_counter()
+        timings = {}
+        app = build_application(with_updater=False)
+        await start_services(app, timings, maintenance=False)
+        timings["total"] = _elapsed_ms(started)
+        await shutdown(app)
+        for phase, ms in timings.items():
+            results.setdefault(phase, []).append(ms)
+
+    print(f"{'phase':<12}{'min':>8}{'median':>8}{'max':>8}   (ms, {runs} runs)")
+    for phase, values in results.items():
+        print(f"{phase:<12}{min(values):>8}{round(statistics.median(values)):>8}{max(values):>8}")
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    if "--bench-startup" in sys.argv:
+        args = sys.argv[sys.argv.index("--bench-startup") + 1:]
+        asyncio.run(bench_startup(int(args[0]) if args else 5))
+    else:
+        asyncio.run(main())